@@ -0,0 +1,300 @@
+"""
+Micro- and macro-benchmarks of the model and the training step, on synthetic tokens.
+Needs neither the fineweb shards nor CUDA: everything runs on CPU by default.
+Timed separately, for each GPTConfig size and each variant (eager, bf16 autocast, torch.compile):
+- CausalSelfAttention, MLP and Block forward and forward+backward
+- the full GPT forward and forward+backward (with loss), and with the chunked loss-only path
+- one AdamW step from configure_optimizers
+- DataLoaderLite.next_batch over synthetic shards
+- KV-cached generation, of one sequence and of a batch of prompts of different lengths
+- with --recompute, GPT forward+backward under each activation recomputation mode, with the bytes
+  autograd keeps for backward, i.e. the memory saved against the extra compute
+- with --ddp_scaling N, instead of the above, the training step (DDP over gloo, gradient accumulation,
+  AdamW) on 1..N CPU processes with their threads pinned to their own cores, i.e. tokens/sec vs ranks
+Results go to a JSON file, and two result files can be diffed to catch regressions:
+$ python bench.py --sizes tiny,small --variants eager,autocast,compile --out bench.json
+$ python bench.py --compare bench_before.json bench.json
+$ python bench.py --sizes 124M --variants autocast --recompute --recompute_every 1
+$ python bench.py --sizes small --variants autocast --ddp_scaling 8 --out bench_ddp.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import statistics
+import dataclasses
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from model import GPT, GPTConfig, CausalSelfAttention, MLP, Block, RECOMPUTE_MODES
+from data import DataLoaderLite
+from train_gpt2 import pin_cpu_threads
+
+SIZES = {
+    "tiny":  dict(n_layer=2,  n_head=4,  n_embd=128, block_size=256),
+    "small": dict(n_layer=6,  n_head=6,  n_embd=384, block_size=512),
+    "124M":  dict(n_layer=12, n_head=12, n_embd=768, block_size=1024),
+}
+
+# -----------------------------------------------------------------------------
+
+def sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+def timeit(fn, device, warmup=2, iters=10):
+    # median and mean wall time of fn() in milliseconds, after a few warmup calls (compilation happens there)
+    for _ in range(warmup):
+        fn()
+    sync(device)
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        sync(device)
+        times.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(times), statistics.fmean(times)
+
+def fwd_bwd(module, *inputs, **kwargs):
+    # forward + backward of a module through the sum of its output (or the loss, for GPT)
+    def fn():
+        module.zero_grad(set_to_none=True)
+        out = module(*inputs, **kwargs)
+        loss = out[1] if isinstance(out, tuple) else out.float().sum()
+        loss.backward()
+    return fn
+
+def activation_bytes(model, *inputs):
+    # bytes of the tensors autograd saves for backward during one forward (weights excluded), on any device
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = model(*inputs)
+    del out
+    return sum(saved.values())
+
+def run_size(size, config, variant, args, tmpdir):
+    device, device_type = args.device, ("cuda" if args.device.startswith("cuda") else "cpu")
+    B, T = args.batch_size, min(args.seq_len, config.block_size)
+    results = []
+
+    def record(bench, fn, tokens=None, **extra):
+        try:
+            median, mean = timeit(fn, device, args.warmup, args.iters)
+        except Exception as e: # e.g. torch.compile without a working compiler toolchain
+            results.append({"size": size, "variant": variant, "bench": bench, "error": f"{type(e).__name__}: {e}"})
+            print(f"{size:>6} {variant:>9} {bench:<18} error: {type(e).__name__}")
+            return
+        row = {"size": size, "variant": variant, "bench": bench, "ms_median": median, "ms_mean": mean}
+        if tokens is not None:
+            row["tokens_per_sec"] = tokens / (median / 1000)
+        row.update(extra)
+        results.append(row)
+        print(f"{size:>6} {variant:>9} {bench:<18} {median:9.3f} ms" + (f" | {row['tokens_per_sec']:,.0f} tok/sec" if tokens else ""))
+
+    def wrap(module):
+        return torch.compile(module) if variant == "compile" else module
+
+    def ctx(fn):
+        # the autocast variant runs the timed function under bf16 autocast
+        if variant != "autocast":
+            return fn
+        def autocast_fn():
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                fn()
+        return autocast_fn
+
+    torch.manual_seed(1337)
+    x = torch.randn(B, T, config.n_embd, device=device)
+    idx = torch.randint(0, config.vocab_size, (B, T), device=device)
+    targets = torch.randint(0, config.vocab_size, (B, T), device=device)
+
+    # sub-modules
+    for name, cls in (("attn", CausalSelfAttention), ("mlp", MLP), ("block", Block)):
+        module = wrap(cls(config).to(device))
+        with torch.no_grad():
+            record(f"{name}.fwd", ctx(lambda: module(x)), B*T)
+        record(f"{name}.fwdbwd", ctx(fwd_bwd(module, x)), B*T)
+
+    # full model
+    model = GPT(config).to(device)
+    compiled = wrap(model)
+    with torch.no_grad():
+        record("gpt.fwd", ctx(lambda: compiled(idx)), B*T)
+    record("gpt.fwdbwd", ctx(fwd_bwd(compiled, idx, targets)), B*T)
+    # the loss only, through the chunked lm_head + cross-entropy (no full logits)
+    record("gpt.fwdbwd_loss", ctx(fwd_bwd(compiled, idx, targets, return_logits=False)), B*T)
+
+    # one optimizer step, with the parameter groups of the training script
+    optimizer = model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+    record("optimizer.step", optimizer.step)
+
+    if variant == "eager":
+        # the data loader has no model variants, time it once per size
+        loader = DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=tmpdir)
+        record("dataloader.next", loader.next_batch, B*T)
+    if variant != "compile":
+        # generation grows the sequence every step, which a static-shape compile would recompile for
+        model.eval()
+        prompt = idx[:1, :8]
+        n_new = min(args.gen_tokens, config.block_size - prompt.size(1))
+        record("generate", ctx(lambda: model.generate(prompt, n_new)), n_new)
+        # a batch of B prompts of different lengths, as in an offline completion job
+        prompts = [idx[b, :8 + b % 8].tolist() for b in range(B)]
+        n_new = min(args.gen_tokens, config.block_size - 16)
+        record("generate_batch", ctx(lambda: model.generate_batch(prompts, n_new, eot=None)), B * n_new)
+    if args.recompute:
+        # activation recomputation: activation memory kept for backward against forward+backward time
+        for mode in RECOMPUTE_MODES:
+            rc_config = dataclasses.replace(config, recompute=mode, recompute_every=args.recompute_every)
+            rc_model = GPT(rc_config).to(device)
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=(variant == "autocast")):
+                act = activation_bytes(rc_model, idx, targets)
+            record(f"recompute.{mode}", ctx(fwd_bwd(wrap(rc_model), idx, targets)), B*T, activation_bytes=act)
+        rows = {r["bench"]: r for r in results if r["bench"].startswith("recompute.") and "ms_median" in r}
+        if "recompute.none" in rows:
+            base = rows["recompute.none"]
+            for mode in RECOMPUTE_MODES[1:]:
+                if f"recompute.{mode}" in rows:
+                    r = rows[f"recompute.{mode}"]
+                    saved = 1 - r["activation_bytes"] / base["activation_bytes"]
+                    overhead = r["ms_median"] / base["ms_median"] - 1
+                    print(f"{size:>6} {variant:>9} recompute={mode:<5} every {args.recompute_every}: activations "
+                          f"{base['activation_bytes'] / 2**20:.1f} -> {r['activation_bytes'] / 2**20:.1f} MiB ({saved:.0%} saved), "
+                          f"fwd+bwd {overhead:+.0%} time")
+    return results
+
+def ddp_worker(rank, world_size, port, size, variant, args, out_file):
+    # one rank of the scaling benchmark: the micro steps and optimizer step of train_gpt2.py, on synthetic tokens
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    cores = pin_cpu_threads(rank, world_size)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    config = GPTConfig(vocab_size=50304, **SIZES[size])
+    B, T = args.batch_size, min(args.seq_len, config.block_size)
+    torch.manual_seed(1337)
+    model = DDP(GPT(config))
+    optimizer = model.module.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type="cpu")
+    idx = torch.randint(0, config.vocab_size, (B, T))
+    targets = torch.randint(0, config.vocab_size, (B, T))
+    def train_step():
+        optimizer.zero_grad(set_to_none=True)
+        for micro_step in range(args.grad_accum):
+            model.require_backward_grad_sync = (micro_step == args.grad_accum - 1)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=(variant == "autocast")):
+                _, loss = model(idx, targets, return_logits=False)
+            (loss / args.grad_accum).backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+    median, mean = timeit(train_step, "cpu", args.warmup, args.iters)
+    # the step is as slow as the slowest rank
+    times = torch.tensor([median, mean])
+    dist.all_reduce(times, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        with open(out_file, "w") as f:
+            json.dump({"ms_median": times[0].item(), "ms_mean": times[1].item(), "threads_per_rank": len(cores)}, f)
+    dist.destroy_process_group()
+
+def ddp_scaling(size, variant, args, tmpdir):
+    # tokens/sec of the training step for 1..args.ddp_scaling ranks, each with a fixed micro batch (weak scaling)
+    results = []
+    config = SIZES[size]
+    T = min(args.seq_len, config["block_size"])
+    for world_size in range(1, args.ddp_scaling + 1):
+        with socket.socket() as s: # a free port for the rendezvous
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        out_file = os.path.join(tmpdir, f"ddp_{world_size}.json")
+        mp.spawn(ddp_worker, args=(world_size, port, size, variant, args, out_file), nprocs=world_size)
+        with open(out_file) as f:
+            row = json.load(f)
+        tokens = world_size * args.grad_accum * args.batch_size * T
+        row.update(size=size, variant=variant, bench=f"ddp.step.{world_size}", world_size=world_size,
+                   tokens_per_sec=tokens / (row["ms_median"] / 1000))
+        row["speedup"] = row["tokens_per_sec"] / results[0]["tokens_per_sec"] if results else 1.0
+        row["efficiency"] = row["speedup"] / world_size
+        results.append(row)
+        print(f"{size:>6} {variant:>9} ranks {world_size:3d} x {row['threads_per_rank']:3d} threads | {row['ms_median']:9.3f} ms | "
+              f"{row['tokens_per_sec']:,.0f} tok/sec | speedup {row['speedup']:.2f}x | efficiency {row['efficiency']:.0%}")
+    return results
+
+def write_synthetic_shards(tmpdir, vocab_size, shard_tokens, num_shards=2):
+    for i in range(num_shards):
+        tokens = np.random.randint(0, vocab_size, size=shard_tokens).astype(np.uint16)
+        np.save(os.path.join(tmpdir, f"synthetic_train_{i:06d}.npy"), tokens)
+
+def compare(before_file, after_file, threshold):
+    # prints the relative change of every benchmark present in both files, flags slowdowns beyond threshold
+    load = lambda f: {(r["size"], r["variant"], r["bench"]): r for r in json.load(open(f))["results"] if "ms_median" in r}
+    before, after = load(before_file), load(after_file)
+    regressions = 0
+    for key in sorted(before.keys() & after.keys()):
+        change = after[key]["ms_median"] / before[key]["ms_median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  <-- REGRESSION"
+            regressions += 1
+        print(f"{key[0]:>6} {key[1]:>9} {key[2]:<18} {before[key]['ms_median']:9.3f} -> {after[key]['ms_median']:9.3f} ms ({change:+.1%}){flag}")
+    print(f"{regressions} regressions beyond {threshold:.0%}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="tiny,small", help=f"comma separated, from {','.join(SIZES)}")
+    parser.add_argument("--variants", type=str, default="eager,autocast", help="comma separated, from eager,autocast,compile")
+    parser.add_argument("--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=256)
+    parser.add_argument("--gen_tokens", type=int, default=32, help="tokens generated in the generate benchmark")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--out", type=str, default="bench.json")
+    parser.add_argument("--recompute", action="store_true", help="also compare the activation recomputation modes")
+    parser.add_argument("--recompute_every", type=int, default=1, help="recompute in every k-th block, with --recompute")
+    parser.add_argument("--ddp_scaling", type=int, default=0, help="benchmark the DDP training step on 1..N CPU processes instead")
+    parser.add_argument("--grad_accum", type=int, default=2, help="micro steps per training step, with --ddp_scaling")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BEFORE", "AFTER"), help="diff two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_synthetic_shards(tmpdir, 50304, shard_tokens=args.batch_size * args.seq_len * 64)
+        for size in args.sizes.split(","):
+            config = GPTConfig(vocab_size=50304, **SIZES[size])
+            for variant in args.variants.split(","):
+                if args.ddp_scaling:
+                    results.extend(ddp_scaling(size, variant, args, tmpdir))
+                else:
+                    results.extend(run_size(size, config, variant, args, tmpdir))
+    meta = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "torch": torch.__version__,
+        "device": args.device,
+        "threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "batch_size": args.batch_size,
+        "seq_len": args.seq_len,
+        "recompute_every": args.recompute_every if args.recompute else None,
+        "grad_accum": args.grad_accum if args.ddp_scaling else None,
+    }
+    with open(args.out, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    print(f"wrote {len(results)} results to {args.out}")
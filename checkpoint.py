@@ -0,0 +1,100 @@
+"""
+Asynchronous, rotating training checkpoints.
+The training loop only pays for copying its state to CPU memory (snapshot), the torch.save to disk
+happens on a background thread. A checkpoint is written to a temporary file, fsync'ed and renamed
+into place, so log/model_XXXXX.pt is either complete or absent, and only the newest keep_last are kept.
+Besides the model and optimizer, a checkpoint stores every rank's data loader position and RNG
+state, so `python train_gpt2.py --resume` continues exactly where the run stopped; resumed with a
+different number of processes, the data loaders pick up from rank 0's position instead.
+"""
+
+import os
+import re
+import threading
+import torch
+
+CHECKPOINT_RE = re.compile(r"^model_(\d+)\.pt$")
+
+# -----------------------------------------------------------------------------
+
+def snapshot(obj, memo=None):
+    # a copy of a (nested) state dict with every tensor copied to CPU, safe to keep while training mutates the original;
+    # tensors that are the same (e.g. the tied wte/lm_head weight) stay one copy, so torch.save writes them once
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), obj.shape, obj.stride(), obj.dtype, obj.device)
+        if key not in memo:
+            memo[key] = obj.detach().to("cpu", copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: snapshot(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+def rng_state():
+    state = {"torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+def list_checkpoints(log_dir):
+    # (step, path) of the finished checkpoints in log_dir, oldest first
+    if not os.path.isdir(log_dir):
+        return []
+    found = []
+    for name in os.listdir(log_dir):
+        m = CHECKPOINT_RE.match(name)
+        if m:
+            found.append((int(m.group(1)), os.path.join(log_dir, name)))
+    return sorted(found)
+
+def latest_checkpoint(log_dir):
+    checkpoints = list_checkpoints(log_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+class AsyncCheckpointer:
+
+    def __init__(self, log_dir, keep_last=3):
+        self.log_dir = log_dir
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, step):
+        # checkpoint must already be a CPU snapshot; waits for the previous write, so at most one is in flight
+        self.wait()
+        path = os.path.join(self.log_dir, f"model_{step:05d}.pt")
+        self.thread = threading.Thread(target=self._write, args=(checkpoint, path), daemon=True)
+        self.thread.start()
+
+    def _write(self, checkpoint, path):
+        try:
+            tmp_path = path + f".tmp{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                torch.save(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._prune()
+        except Exception as e:
+            self.error = e # re-raised in the training loop by the next save() or wait()
+
+    def _prune(self):
+        if self.keep_last is None:
+            return
+        for _, path in list_checkpoints(self.log_dir)[:-self.keep_last]:
+            os.remove(path)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,325 @@
+"""
+Token shard loaders for training: sequential (DataLoaderLite), document-shuffled
+(ShuffledDataLoader), and a background-thread prefetcher around either (PrefetchLoader),
+plus the fixed validation windows kept resident on the device (ValidationSet).
+Shards are the uint16 .npy files written by fineweb.py, memory-mapped rather than read.
+"""
+
+import os
+import queue
+import threading
+import numpy as np
+import torch
+
+def load_tokens(filename):
+    # memory-map the uint16 shard instead of reading and widening all of it: opening a shard is
+    # (nearly) free and resident memory stays flat, only the pages actually sliced get touched
+    npt = np.load(filename, mmap_mode='r')
+    return npt
+
+def tokens_to_tensor(npt):
+    # widen just the slice we return (uint16 -> int64), copying it out of the memory map
+    return torch.from_numpy(npt.astype(np.int64))
+
+class DataLoaderLite:
+    def __init__(self, B, T, process_rank, num_processes, split, data_root="edu_fineweb10B"):
+        self.B = B
+        self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        assert split in {'train', 'val'}
+
+        # with open('input.txt', 'r') as f:
+        #     text = f.read()
+        # enc = tiktoken.get_encoding('gpt2') # GPT-2 토크나이저 사용
+        # tokens = enc.encode(text)
+        # self.tokens = torch.tensor(tokens)
+        # print(f"loaded {len(self.tokens)} tokens")
+        # print(f"1 epoch = {len(self.tokens) // (B * T)} batches")
+        
+        shards = os.listdir(data_root)
+        shards = [s for s in shards if split in s and s.endswith(".npy")] # skip the .idx document indexes
+        shards = sorted(shards)
+        shards = [os.path.join(data_root, s) for s in shards]
+        self.shards = shards
+        assert len(shards) > 0, f"no shards found for split {split}"
+        if process_rank == 0:
+            print(f"found {len(shards)} shards for split {split}")
+        self.reset()
+
+        # self.current_shard = 0
+        # self.tokens = load_tokens(self.shards[self.current_shard])
+               
+        # # state
+        # # self.current_position = 0
+        # self.current_position = self.B * self.T * self.process_rank
+    def reset(self):
+        # state, init at shard zero
+        self.current_shard = 0
+        self.tokens = load_tokens(self.shards[self.current_shard])
+        self.current_position = self.B * self.T * self.process_rank
+
+    def next_batch(self):
+        B, T = self.B, self.T
+        buf = tokens_to_tensor(self.tokens[self.current_position : self.current_position+B*T+1])
+        x = (buf[:-1]).view(B, T) # inputs
+        y = (buf[1:]).view(B, T) # targets
+        # advance the position in the tensor
+        # self.current_position += B * T
+        self.current_position += B * T * self.num_processes
+        # if loading the next batch would be out of bounds, reset
+        # if self.current_position + (B * T + 1) > len(self.tokens):
+        #     self.current_position = 0 # 데이터를 다 사용했으면, 다시 0으로 돌아와서 다음 에폭을 시작하자.
+        if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
+            self.current_shard = (self.current_shard + 1) % len(self.shards)
+            self.tokens = load_tokens(self.shards[self.current_shard])
+            self.current_position = self.B * self.T * self.process_rank # 데이터를 다 사용했으면, 다시 0으로 돌아와서 다음 에폭을 시작하자.
+        return x, y
+
+    def state_dict(self):
+        # where the next batch starts, enough to resume without replaying or skipping batches
+        return {"current_shard": self.current_shard, "current_position": self.current_position,
+                "process_rank": self.process_rank, "num_processes": self.num_processes, "B": self.B, "T": self.T}
+
+    @staticmethod
+    def resume_state(states):
+        # of the states of all ranks of a run, the one to re-map from with a different number of processes:
+        # rank 0's, which is furthest behind (the other ranks read the windows after it, and move on to the
+        # next shard no later than it does)
+        return states[0]
+
+    def load_state_dict(self, state):
+        """
+        Continues from state, opening only its shard. The state of any one rank of a run with a different
+        number of processes (or B, T) also works: the ranks of a step read consecutive B*T windows, so the
+        step's start is the rank's position less rank * B*T, and this rank's window of it follows from there.
+        Load resume_state(the states of all old ranks), so no window of the old run is skipped.
+        """
+        self.current_shard = state["current_shard"]
+        self.tokens = load_tokens(self.shards[self.current_shard])
+        self.current_position = state["current_position"]
+        old_layout = (state.get("process_rank", self.process_rank), state.get("num_processes", self.num_processes),
+                      state.get("B", self.B), state.get("T", self.T))
+        if old_layout != (self.process_rank, self.num_processes, self.B, self.T):
+            old_rank, _, old_B, old_T = old_layout
+            step_start = self.current_position - old_B * old_T * old_rank
+            self.current_position = step_start + self.B * self.T * self.process_rank
+            if self.current_position + (self.B * self.T * self.num_processes + 1) > len(self.tokens):
+                # the new ranks don't fit in what is left of the shard, move on to the next one as next_batch would
+                self.current_shard = (self.current_shard + 1) % len(self.shards)
+                self.tokens = load_tokens(self.shards[self.current_shard])
+                self.current_position = self.B * self.T * self.process_rank
+
+class ShuffledDataLoader:
+    """
+    Drop-in alternative to DataLoaderLite that shuffles at the document level.
+    Uses the .idx document index written next to each shard by fineweb.py: every epoch the shards
+    are shuffled and taken shards_per_group at a time (None: all of them), the documents of a group are
+    permuted, and rank r keeps documents r, r+world_size, ... of that permutation. Each rank then packs
+    its documents back to back into B*T windows read straight from the memory-mapped shards.
+    The order only depends on (seed, epoch), so it is deterministic and the ranks are disjoint.
+    """
+
+    def __init__(self, B, T, process_rank, num_processes, split, seed=1337, shards_per_group=None, data_root="edu_fineweb10B"):
+        self.B = B
+        self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.seed = seed
+        assert split in {'train', 'val'}
+        shards = sorted(s for s in os.listdir(data_root) if split in s and s.endswith(".npy"))
+        self.shards = [os.path.join(data_root, s) for s in shards]
+        assert len(self.shards) > 0, f"no shards found for split {split}"
+        for shard in self.shards:
+            assert os.path.exists(shard[:-len(".npy")] + ".idx"), f"missing document index for {shard}, run: python fineweb.py --index_only"
+        self.shards_per_group = shards_per_group or len(self.shards)
+        if process_rank == 0:
+            print(f"found {len(self.shards)} shards for split {split}, shuffling documents within groups of {self.shards_per_group}")
+        self.reset()
+
+    def reset(self):
+        self.epoch = 0
+        self.group = 0
+        self._load_group()
+
+    def _load_group(self):
+        # this rank's documents of the current group, as (shard, start, end) in shuffled order
+        rng = np.random.default_rng((self.seed, self.epoch))
+        shard_order = rng.permutation(len(self.shards))
+        group = shard_order[self.group*self.shards_per_group : (self.group+1)*self.shards_per_group]
+        self.tokens = {int(i): load_tokens(self.shards[i]) for i in group}
+        doc_shard, doc_start, doc_end = [], [], []
+        for i, tokens in self.tokens.items():
+            starts = np.load(self.shards[i][:-len(".npy")] + ".idx").astype(np.int64)
+            if len(starts) == 0 or starts[0] != 0:
+                starts = np.insert(starts, 0, 0) # the shard opens with the tail of a document from the previous one
+            doc_shard.append(np.full(len(starts), i))
+            doc_start.append(starts)
+            doc_end.append(np.append(starts[1:], len(tokens)))
+        perm = np.random.default_rng((self.seed, self.epoch, self.group + 1)).permutation(sum(len(d) for d in doc_start))
+        mine = perm[self.process_rank::self.num_processes]
+        self.doc_shard = np.concatenate(doc_shard)[mine]
+        self.doc_start = np.concatenate(doc_start)[mine]
+        self.doc_end = np.concatenate(doc_end)[mine]
+        self.current_doc = 0 # position in this rank's document list
+        self.current_offset = 0 # tokens of the current document already consumed
+
+    def _next_group(self):
+        self.group += 1
+        if self.group * self.shards_per_group >= len(self.shards):
+            self.epoch += 1
+            self.group = 0
+        self._load_group()
+
+    def next_batch(self):
+        B, T = self.B, self.T
+        buf = np.empty(B*T+1, dtype=np.int64)
+        filled = 0
+        doc, offset = self.current_doc, self.current_offset
+        while filled < B*T+1:
+            if doc == len(self.doc_start):
+                # out of documents in this group, continue the batch in the next one
+                self._next_group()
+                doc, offset = 0, 0
+            start = self.doc_start[doc] + offset
+            n = min(B*T+1 - filled, self.doc_end[doc] - start)
+            buf[filled:filled+n] = self.tokens[self.doc_shard[doc]][start:start+n]
+            if filled <= B*T < filled + n:
+                # token B*T (this batch's last target) is where the next batch starts
+                self.current_doc, self.current_offset = doc, offset + (B*T - filled)
+            filled += n
+            offset += n
+            if self.doc_start[doc] + offset == self.doc_end[doc]:
+                doc, offset = doc + 1, 0
+        buf = torch.from_numpy(buf)
+        x = (buf[:-1]).view(B, T) # inputs
+        y = (buf[1:]).view(B, T) # targets
+        return x, y
+
+    def state_dict(self):
+        # the document order is a function of (seed, epoch, group), so this pins down the next batch
+        return {"seed": self.seed, "epoch": self.epoch, "group": self.group,
+                "current_doc": int(self.current_doc), "current_offset": int(self.current_offset),
+                "process_rank": self.process_rank, "num_processes": self.num_processes}
+
+    @staticmethod
+    def resume_state(states):
+        # of the states of all ranks of a run, the one to re-map from with a different number of processes:
+        # the rank furthest behind in (epoch, group, position in the group's permutation), which varies
+        # with the lengths of the documents each rank happened to read
+        def progress(rank):
+            state = states[rank]
+            num_processes = state.get("num_processes", len(states))
+            return (state["epoch"], state["group"], state.get("process_rank", rank) + state["current_doc"] * num_processes)
+        return states[min(range(len(states)), key=progress)]
+
+    def load_state_dict(self, state):
+        """
+        Continues from state, rebuilding only its group's document order. The state of one rank of a run
+        with a different number of processes also works: rank r's document k is document r + k*num_processes
+        of the group's permutation, so this rank continues from its first document at or after that one.
+        Load resume_state(the states of all old ranks), the one furthest behind, so no document the old run
+        hadn't reached is skipped. The re-map is approximate: the ranks read documents of different lengths,
+        so documents after that one that ranks further ahead had already read are read again.
+        """
+        assert state["seed"] == self.seed, "resuming with a different shuffle seed"
+        self.epoch, self.group = state["epoch"], state["group"]
+        self._load_group()
+        self.current_doc, self.current_offset = state["current_doc"], state["current_offset"]
+        old_rank = state.get("process_rank", self.process_rank)
+        old_num_processes = state.get("num_processes", self.num_processes)
+        if (old_rank, old_num_processes) != (self.process_rank, self.num_processes):
+            doc = old_rank + self.current_doc * old_num_processes # in the group's permutation
+            self.current_doc = max(0, -(-(doc - self.process_rank) // self.num_processes))
+            if self.process_rank + self.current_doc * self.num_processes != doc:
+                self.current_offset = 0 # a different document than the old rank was in
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoaderLite and runs its next_batch() on a background thread, keeping a bounded
+    queue of ready (x, y) batches (in pinned memory when the target device is CUDA, so the
+    host-to-device copy can be non-blocking). When the loader gets close to the end of its shard,
+    the thread also reads the next shard once so its pages are in the page cache before the switch.
+    state_dict() is the wrapped loader's state as of the last batch handed out, so batches still in
+    the queue are not lost by a checkpoint; restore a loader's state before wrapping it.
+    """
+
+    def __init__(self, loader, depth=4, pin_memory=False):
+        self.loader = loader
+        self.B, self.T = loader.B, loader.T
+        self.pin_memory = pin_memory
+        self.queue = queue.Queue(maxsize=depth)
+        self.state = loader.state_dict() # position after the last batch handed out (not the last one prefetched)
+        self.warm_shards = isinstance(loader, DataLoaderLite) # a ShuffledDataLoader reads its shards at random
+        self.warmed_shard = loader.current_shard if self.warm_shards else None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _warm_next_shard(self):
+        loader = self.loader
+        stride = loader.B * loader.T * loader.num_processes
+        next_shard = (loader.current_shard + 1) % len(loader.shards)
+        if next_shard == self.warmed_shard:
+            return
+        # start reading ahead once we are within a few queue-lengths of the shard end
+        if loader.current_position + (self.queue.maxsize + 2) * stride + 1 > len(loader.tokens):
+            with open(loader.shards[next_shard], "rb") as f:
+                while f.read(1 << 24):
+                    pass
+            self.warmed_shard = next_shard
+
+    def _worker(self):
+        try:
+            while True:
+                x, y = self.loader.next_batch()
+                if self.pin_memory:
+                    x, y = x.pin_memory(), y.pin_memory()
+                self.queue.put((x, y, self.loader.state_dict()))
+                if self.warm_shards:
+                    self._warm_next_shard()
+        except Exception as e:
+            self.queue.put(e) # surface the error in the training loop instead of hanging it
+
+    def next_batch(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        x, y, self.state = item
+        return x, y
+
+    def state_dict(self):
+        return self.state
+
+class ValidationSet:
+    """
+    The fixed validation windows, read once and kept resident on the device, so an evaluation is only
+    forward passes (no shard reload, no uint16 -> int64 conversion). They are exactly the first `steps`
+    batches DataLoaderLite(split="val") hands this process after reset(), so the mean loss is the same
+    as averaging those batches. Every input token also carries the index of its document (documents
+    start at an <|endoftext|> token in fineweb.py's shards), for the per-document loss.
+    """
+
+    def __init__(self, B, T, steps, process_rank, num_processes, device, data_root="edu_fineweb10B", eot=50256):
+        loader = DataLoaderLite(B=B, T=T, process_rank=process_rank, num_processes=num_processes, split="val", data_root=data_root)
+        xs, ys, keys = [], [], []
+        eot_positions = {} # shard -> positions of its eot tokens, i.e. where its documents start
+        for _ in range(steps):
+            shard, position = loader.current_shard, loader.current_position
+            if shard not in eot_positions:
+                idx_file = loader.shards[shard][:-len(".npy")] + ".idx"
+                if os.path.exists(idx_file):
+                    eot_positions[shard] = np.load(idx_file).astype(np.int64)
+                else:
+                    eot_positions[shard] = np.flatnonzero(loader.tokens == eot) # one pass over the shard
+            x, y = loader.next_batch()
+            xs.append(x)
+            ys.append(y)
+            # the document of a token is the number of document starts at or before it, unique across shards
+            doc = np.searchsorted(eot_positions[shard], np.arange(position, position + B*T), side="right")
+            keys.append((shard << 40) | doc)
+        self.x = torch.cat(xs).to(device) # (steps*B, T)
+        self.y = torch.cat(ys).to(device)
+        doc_keys = torch.from_numpy(np.concatenate(keys)).view(-1, T)
+        self.doc_keys, doc_index = torch.unique(doc_keys, return_inverse=True) # (D,) sorted, and (steps*B, T) into it
+        self.doc_index = doc_index.to(device)
+        self.doc_count = torch.bincount(doc_index.view(-1), minlength=len(self.doc_keys)).to(device)
@@ -0,0 +1,121 @@
+"""
+Evaluation of a GPT: mean loss on the fineweb validation shards and HellaSwag accuracy.
+The training loop calls these every so often; run on its own, it evaluates a checkpoint or a
+pretrained GPT-2:
+$ python eval_gpt2.py --init_from log/model_19072.pt
+$ python eval_gpt2.py --init_from gpt2 --device cuda
+"""
+
+import time
+import argparse
+import torch
+import torch.distributed as dist
+from torch.nn import functional as F
+from hellaswag import iterate_batches, get_most_likely_rows
+from data import ValidationSet
+from model import load_model
+from metrics import compile_stats, format_compile_stats
+
+# -----------------------------------------------------------------------------
+
+def evaluate_loss(model, val_set, batch_size, device_type):
+    """
+    One pass over the resident windows of a ValidationSet, batch_size rows per forward, returns
+    (mean loss, mean loss at each of the T positions, mean over documents of each document's mean loss),
+    over all processes when running distributed.
+    """
+    model.eval()
+    N, T = val_set.x.shape
+    with torch.inference_mode():
+        position_loss = torch.zeros(T, dtype=torch.float32, device=val_set.x.device)
+        doc_loss = torch.zeros(len(val_set.doc_keys), dtype=torch.float32, device=val_set.x.device)
+        for i in range(0, N, batch_size):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                _, loss = model(val_set.x[i:i+batch_size], val_set.y[i:i+batch_size], return_logits=False, reduction="none") # (b, T)
+            position_loss += loss.sum(dim=0)
+            doc_loss.index_add_(0, val_set.doc_index[i:i+batch_size].reshape(-1), loss.reshape(-1))
+    # the collectives below write in place, which inference tensors don't allow outside inference mode
+    position_loss, doc_loss = position_loss.clone(), doc_loss.clone()
+    doc_keys, doc_count = val_set.doc_keys, val_set.doc_count.float()
+    num_rows = N
+    if dist.is_available() and dist.is_initialized():
+        world_size = dist.get_world_size()
+        dist.all_reduce(position_loss, op=dist.ReduceOp.SUM)
+        num_rows *= world_size
+        # a document can be split over processes, merge the per-document sums by document key
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (doc_keys, doc_loss.cpu(), doc_count.cpu()))
+        doc_keys, inverse = torch.unique(torch.cat([g[0] for g in gathered]), return_inverse=True)
+        doc_loss = torch.zeros(len(doc_keys)).index_add_(0, inverse, torch.cat([g[1] for g in gathered]))
+        doc_count = torch.zeros(len(doc_keys)).index_add_(0, inverse, torch.cat([g[2] for g in gathered]))
+    val_loss = position_loss.sum().item() / (num_rows * T)
+    return val_loss, (position_loss / num_rows).tolist(), (doc_loss / doc_count).mean().item()
+
+def pad_batch(tokens, mask, rows, multiple):
+    # right-pads a HellaSwag batch to `rows` rows and a length that is a multiple of `multiple`, so that a
+    # compiled model sees a handful of shapes instead of one per batch. The padding is masked out, and on the
+    # right it doesn't change the logits of the real tokens of a causal model.
+    pad_len = -tokens.size(1) % multiple
+    pad_rows = rows - tokens.size(0)
+    return F.pad(tokens, (0, pad_len, 0, pad_rows)), F.pad(mask, (0, pad_len, 0, pad_rows))
+
+@torch.inference_mode()
+def evaluate_hellaswag(model, device, device_type, batch_size=16, rank=0, world_size=1, pad_to=None):
+    # (num_correct_norm, num_total) over the examples where i % world_size == rank,
+    # length-sorted and packed batch_size per forward, padded with pad_batch when pad_to is given
+    model.eval()
+    num_correct_norm = 0
+    num_total = 0
+    for _, tokens, mask, labels in iterate_batches("val", batch_size=batch_size, rank=rank, world_size=world_size):
+        rows = tokens.size(0)
+        if pad_to is not None:
+            tokens, mask = pad_batch(tokens, mask, 4 * batch_size, pad_to)
+        tokens = tokens.to(device)
+        mask = mask.to(device)
+        labels = labels.to(device)
+        # get the logits
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            logits, loss = model(tokens)
+        _, _, pred_norm = get_most_likely_rows(tokens[:rows], mask[:rows], logits[:rows])
+        num_total += labels.size(0)
+        num_correct_norm += (pred_norm == labels).sum().item()
+    return num_correct_norm, num_total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--init_from", type=str, default="gpt2", help="gpt2/gpt2-medium/... or a checkpoint path")
+    parser.add_argument("--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--data_root", type=str, default="edu_fineweb10B", help="directory of the tokenized shards")
+    parser.add_argument("--batch_size", type=int, default=32, help="B of the validation windows (B*T*val_steps tokens)")
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--val_steps", type=int, default=20, help="validation batches to average the loss over")
+    parser.add_argument("--eval_batch_size", type=int, default=64, help="validation rows per forward")
+    parser.add_argument("--hella_batch_size", type=int, default=16, help="HellaSwag examples (x4 rows) per forward")
+    parser.add_argument("--no_hellaswag", action="store_true", help="only compute the validation loss")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model, with dynamic shapes")
+    parser.add_argument("--pad_to", type=int, default=64, help="with --compile, pad HellaSwag batches to multiples of this length")
+    args = parser.parse_args()
+
+    device_type = "cuda" if args.device.startswith("cuda") else "cpu"
+    torch.set_float32_matmul_precision('high')
+    model = load_model(args.init_from, args.device)
+    if args.compile:
+        model = torch.compile(model, dynamic=True)
+    t0 = time.time()
+    val_set = ValidationSet(args.batch_size, args.seq_len, args.val_steps, 0, 1, args.device, data_root=args.data_root)
+    val_loss, position_loss, doc_loss = evaluate_loss(model, val_set, args.eval_batch_size, device_type)
+    print(f"validation loss: {val_loss:.4f} | per-document: {doc_loss:.4f}")
+    T = len(position_loss)
+    for lo, hi in ((0, 1), (1, 16), (16, 128), (128, T)):
+        if lo < T:
+            print(f"positions {lo:4d}-{min(hi, T)-1:4d}: {sum(position_loss[lo:hi]) / len(position_loss[lo:hi]):.4f}")
+    if not args.no_hellaswag:
+        pad_to = args.pad_to if args.compile else None
+        num_correct_norm, num_total = evaluate_hellaswag(model, args.device, device_type, args.hella_batch_size, pad_to=pad_to)
+        print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={num_correct_norm / num_total:.4f}")
+    if args.compile:
+        stats = compile_stats()
+        print(f"torch.compile: {format_compile_stats(stats)}, {time.time() - t0:.1f}s total")
+
+if __name__ == "__main__":
+    main()
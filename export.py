@@ -0,0 +1,49 @@
+"""
+Export a GPT for inference: a .safetensors file with the weights in bf16 (or fp16), the tied
+wte/lm_head weight stored once, no optimizer state, and the GPTConfig in the JSON header; no pickle,
+so loading it runs no code. load_model(path) memory-maps it: tensors are read from disk lazily, and
+inference processes on one host that load the same file share its pages in the page cache.
+
+$ python export.py --init_from log/model_19072.pt --out log/model_19072.safetensors
+$ python export.py --init_from gpt2 --out gpt2.safetensors --dtype float16
+$ python serve.py --init_from log/model_19072.safetensors
+"""
+
+import os
+import time
+import argparse
+import torch
+from model import export_model, load_model
+
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+
+# -----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--init_from", type=str, default="gpt2", help="gpt2/gpt2-medium/..., a checkpoint or a .safetensors path")
+    parser.add_argument("--out", type=str, required=True, help="the .safetensors file to write")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=list(DTYPES), help="dtype of the exported weights")
+    args = parser.parse_args()
+    assert args.out.endswith(".safetensors"), "load_model recognizes exported files by the .safetensors extension"
+
+    # checkpoints are memory-mapped, so the optimizer state they carry is never read
+    model = load_model(args.init_from)
+    t0 = time.time()
+    export_model(model, args.out, DTYPES[args.dtype])
+    print(f"wrote {args.out} in {time.time() - t0:.1f}s")
+    if os.path.isfile(args.init_from):
+        print(f"{args.init_from}: {os.path.getsize(args.init_from) / 1e6:,.1f}MB")
+    print(f"{args.out}: {os.path.getsize(args.out) / 1e6:,.1f}MB ({sum(p.numel() for p in model.parameters()):,} parameters in {args.dtype})")
+
+    # check the file loads back to the same model, up to the rounding to dtype
+    exported = load_model(args.out)
+    assert exported.lm_head.weight is exported.transformer.wte.weight
+    x = torch.randint(0, model.config.vocab_size, (1, min(64, model.config.block_size)))
+    with torch.no_grad():
+        logits, _ = model(x)
+        exported_logits, _ = exported(x)
+    print(f"max |logits diff|: {(logits.float() - exported_logits.float()).abs().max().item():.4f}")
+
+if __name__ == "__main__":
+    main()
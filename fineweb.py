@@ -5,78 +5,294 @@ Downloads and tokenizes the data and saves data shards to disk.
 Run simply as:
 $ python fineweb.py
 Will save shards to the local directory "edu_fineweb10B".
+Every finished shard is recorded (with its sha256) in manifest.json in that directory,
+so rerunning the same command after a crash resumes right after the last complete shard.
+Next to each shard a .idx file holds the start offsets of its documents (their <|endoftext|>
+positions), used by the shuffled sampler in train_gpt2.py. For older shards, add them with:
+$ python fineweb.py --index_only
+To tokenize local files instead of the HF hub, point --source at a .jsonl/.parquet file
+(or a directory of them) with a "text" field/column:
+$ python fineweb.py --source path/to/docs.jsonl --local_dir my_shards
 """
 
 import os
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import itertools
 import multiprocessing as mp
 import numpy as np
 import tiktoken
-from datasets import load_dataset # pip install datasets
 from tqdm import tqdm # pip install tqdm
 
 # ------------------------------------------
-local_dir = "edu_fineweb10B"
-remote_name = "sample-10BT"
-shard_size = int(1e8) # 100M tokens per shard, total of 100 shards
-
-# create the cache the local directory if it doesn't exist yet
-DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), local_dir)
-os.makedirs(DATA_CACHE_DIR, exist_ok=True)
-
-# download the dataset
-fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
-
 # init the tokenizer
 enc = tiktoken.get_encoding("gpt2")
 eot = enc._special_tokens['<|endoftext|>'] # end of text token
-def tokenize(doc):
-    # tokenizes a single document and returns a numpy array of uint16 tokens
-    tokens = [eot] # the special <|endoftext|> token delimits all documents
-    tokens.extend(enc.encode_ordinary(doc["text"]))
-    tokens_np = np.array(tokens)
+MANIFEST = "manifest.json"
+
+def tokenize(texts):
+    # tokenizes a batch of documents and returns: the uint16 tokens of all of them concatenated,
+    # each prefixed by the special <|endoftext|> token that delimits documents, the number of tokens
+    # of each document (including its <|endoftext|>), and the time spent encoding
+    t0 = time.time()
+    docs = enc.encode_ordinary_batch(texts, num_threads=1) # one thread each, the pool gives us the parallelism
+    doc_lens = np.fromiter((len(doc) + 1 for doc in docs), dtype=np.int64, count=len(docs))
+    tokens = itertools.chain.from_iterable(itertools.chain((eot,), doc) for doc in docs)
+    tokens_np = np.fromiter(tokens, dtype=np.int64, count=int(doc_lens.sum()))
     assert (0 <= tokens_np).all() and (tokens_np < 2**16).all(), "token dictionary too large for uint16"
     tokens_np_uint16 = tokens_np.astype(np.uint16)
-    return tokens_np_uint16
-
-def write_datafile(filename, tokens_np):
-    np.save(filename, tokens_np)
-
-# tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
-nprocs = max(1, os.cpu_count()//2)
-with mp.Pool(nprocs) as pool:
-    shard_index = 0
-    # preallocate buffer to hold current shard
-    all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
-    token_count = 0
-    progress_bar = None
-    for tokens in pool.imap(tokenize, fw, chunksize=16):
-
-        # is there enough space in the current shard for the new tokens?
-        if token_count + len(tokens) < shard_size:
-            # simply append tokens to current shard
-            all_tokens_np[token_count:token_count+len(tokens)] = tokens
-            token_count += len(tokens)
-            # update progress bar
-            if progress_bar is None:
-                progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
-            progress_bar.update(len(tokens))
+    return tokens_np_uint16, doc_lens, time.time() - t0
+
+def iterate_documents(source, remote_name, start):
+    # yields the text of every document of the source, starting at document index start
+    if source == "hf":
+        from datasets import load_dataset # pip install datasets
+        fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
+        for i in range(start, len(fw), 1024):
+            yield from fw[i:i+1024]["text"]
+        return
+    if os.path.isdir(source):
+        files = sorted(os.path.join(source, f) for f in os.listdir(source) if f.endswith((".jsonl", ".parquet")))
+    else:
+        files = [source]
+    doc_index = 0
+    for filename in files:
+        if filename.endswith(".parquet"):
+            import pyarrow.parquet as pq # pip install pyarrow
+            pf = pq.ParquetFile(filename)
+            if doc_index + pf.metadata.num_rows <= start:
+                doc_index += pf.metadata.num_rows # skip whole files without reading them
+                continue
+            for batch in pf.iter_batches(columns=["text"]):
+                for text in batch.column(0).to_pylist():
+                    if doc_index >= start:
+                        yield text
+                    doc_index += 1
         else:
-            # write the current shard and start a new one
+            with open(filename, "r") as f:
+                for line in f:
+                    if doc_index >= start:
+                        yield json.loads(line)["text"]
+                    doc_index += 1
+
+def batched(iterable, n):
+    # groups an iterable into lists of n items (the last one may be shorter)
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+class StageTimer:
+    # accumulates the wall time spent inside a generator, i.e. the read stage of the pipeline
+    def __init__(self, iterable):
+        self.it = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = time.time()
+        try:
+            return next(self.it)
+        finally:
+            self.seconds += time.time() - t0
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while chunk := f.read(1 << 24):
+            h.update(chunk)
+    return h.hexdigest()
+
+def index_filename(filename):
+    # the document index of a shard sits next to it: edufineweb_train_000001.npy -> edufineweb_train_000001.idx
+    return filename[:-len(".npy")] + ".idx"
+
+def write_index(filename, tokens_np):
+    # documents start at their <|endoftext|> token, so the index is just the (uint32) positions of those
+    doc_starts = np.flatnonzero(tokens_np == eot).astype(np.uint32)
+    path = index_filename(filename)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, doc_starts)
+    os.replace(path + ".tmp", path)
+    return len(doc_starts)
+
+def save_manifest(out_dir, manifest):
+    # write to a temporary file and rename, so the manifest on disk is always complete
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def load_manifest(out_dir, args):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"source": args.source, "remote_name": args.remote_name, "shard_size": args.shard_size, "complete": False, "shards": []}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    for key in ("source", "remote_name", "shard_size"):
+        assert manifest[key] == getattr(args, key), f"{path} was written with {key}={manifest[key]!r}, cannot resume with {getattr(args, key)!r}"
+    return manifest
+
+class ShardWriter:
+    """
+    Writes shards on a background thread so tokenization never waits on disk.
+    Each shard goes to a temporary file that is fsynced and atomically renamed, and only then
+    recorded in the manifest together with its sha256, so the manifest only lists complete shards.
+    """
+
+    def __init__(self, out_dir, manifest, max_pending=2):
+        self.out_dir = out_dir
+        self.manifest = manifest
+        self.queue = queue.Queue(maxsize=max_pending) # bounds the memory held by shards waiting to be written
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while (item := self.queue.get()) is not None:
+            if self.error is not None:
+                continue # keep draining after a failure, so submit() and close() never block on a full queue
+            entry, tokens_np, stats = item
+            try:
+                t0 = time.time()
+                path = os.path.join(self.out_dir, entry["filename"])
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, tokens_np)
+                    f.flush()
+                    os.fsync(f.fileno())
+                entry["sha256"] = file_sha256(path + ".tmp")
+                os.replace(path + ".tmp", path)
+                entry["num_docs"] = write_index(path, tokens_np)
+                self.manifest["shards"].append(entry)
+                save_manifest(self.out_dir, self.manifest)
+                stats["write"] = time.time() - t0
+                n = entry["num_tokens"]
+                rates = " | ".join(f"{stage}: {n / max(t, 1e-9):,.0f} tok/s" for stage, t in stats.items())
+                tqdm.write(f"wrote {entry['filename']} | {rates}")
+            except Exception as e:
+                self.error = e # raised in the main thread by the next submit() or close()
+
+    def submit(self, entry, tokens_np, stats):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((entry, tokens_np, stats))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize a text corpus into uint16 GPT-2 token shards")
+    parser.add_argument("--source", type=str, default="hf", help="'hf' for FineWeb-Edu on the HF hub, or a local .jsonl/.parquet file or directory")
+    parser.add_argument("--remote_name", type=str, default="sample-10BT", help="FineWeb-Edu subset when --source=hf")
+    parser.add_argument("--local_dir", type=str, default="edu_fineweb10B", help="output directory (relative to this file)")
+    parser.add_argument("--shard_size", type=int, default=int(1e8), help="tokens per shard") # 100M tokens per shard, total of 100 shards
+    parser.add_argument("--docs_per_batch", type=int, default=256, help="documents per encode_ordinary_batch task")
+    parser.add_argument("--num_proc", type=int, default=max(1, os.cpu_count()//2), help="tokenizer processes")
+    parser.add_argument("--verify", action="store_true", help="re-check the sha256 of existing shards before resuming")
+    parser.add_argument("--index_only", action="store_true", help="only write the missing document indexes of existing shards")
+    args = parser.parse_args()
+
+    # create the cache the local directory if it doesn't exist yet
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.local_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if args.index_only:
+        # shards written before the indexes existed
+        for filename in sorted(f for f in os.listdir(out_dir) if f.endswith(".npy")):
+            path = os.path.join(out_dir, filename)
+            if not os.path.exists(index_filename(path)):
+                num_docs = write_index(path, np.load(path, mmap_mode="r"))
+                print(f"indexed {filename}: {num_docs} documents")
+        return
+    manifest = load_manifest(out_dir, args)
+    if manifest["complete"]:
+        print(f"{out_dir} already holds all {len(manifest['shards'])} shards")
+        return
+    if args.verify:
+        for entry in manifest["shards"]:
+            assert file_sha256(os.path.join(out_dir, entry["filename"])) == entry["sha256"], f"checksum mismatch for {entry['filename']}"
+
+    # resume point: the first document not fully written yet, and how many of its tokens already were
+    shard_index = len(manifest["shards"])
+    next_doc, skip_tokens = 0, 0
+    if manifest["shards"]:
+        next_doc, skip_tokens = manifest["shards"][-1]["next_doc"], manifest["shards"][-1]["skip_tokens"]
+        print(f"resuming at shard {shard_index}, document {next_doc}")
+
+    # tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
+    writer = ShardWriter(out_dir, manifest)
+    reader = StageTimer(iterate_documents(args.source, args.remote_name, next_doc))
+    doc_index = next_doc # index of the first document of the current batch
+    with mp.Pool(args.num_proc) as pool:
+        # preallocate buffer to hold current shard
+        all_tokens_np = np.empty((args.shard_size,), dtype=np.uint16)
+        token_count = 0
+        encode_time = 0.0
+        progress_bar = None
+
+        def close_shard(n_tokens, next_doc, skip_tokens):
+            nonlocal all_tokens_np, token_count, encode_time, shard_index, progress_bar
             split = "val" if shard_index == 0 else "train"
-            filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-            # split the document into whatever fits in this shard; the remainder goes to next one
-            remainder = shard_size - token_count
-            progress_bar.update(remainder)
-            all_tokens_np[token_count:token_count+remainder] = tokens[:remainder]
-            write_datafile(filename, all_tokens_np)
+            entry = {"filename": f"edufineweb_{split}_{shard_index:06d}.npy", "num_tokens": n_tokens,
+                     "next_doc": next_doc, "skip_tokens": skip_tokens}
+            # encode time is summed over the workers, so divide by their number for the pipeline rate
+            stats = {"read": reader.seconds, "tokenize": encode_time / args.num_proc}
+            writer.submit(entry, all_tokens_np[:n_tokens], stats)
+            reader.seconds = encode_time = 0.0
+            # hand the full buffer to the writer and start a fresh one for the next shard
+            all_tokens_np = np.empty((args.shard_size,), dtype=np.uint16)
+            token_count = 0
             shard_index += 1
+            progress_bar.close()
             progress_bar = None
-            # populate the next shard with the leftovers of the current doc
-            all_tokens_np[0:len(tokens)-remainder] = tokens[remainder:]
-            token_count = len(tokens)-remainder
-
-    # write any remaining tokens as the last shard
-    if token_count != 0:
-        split = "val" if shard_index == 0 else "train"
-        filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-        write_datafile(filename, all_tokens_np[:token_count])
\ No newline at end of file
+
+        # Pool.imap would pull the whole source into its task queue, so keep a bounded number of batches in flight
+        in_flight = threading.BoundedSemaphore(4 * args.num_proc)
+        def throttled(batches):
+            for batch in batches:
+                in_flight.acquire()
+                yield batch
+
+        for tokens, doc_lens, dt in pool.imap(tokenize, throttled(batched(reader, args.docs_per_batch))):
+            in_flight.release()
+            encode_time += dt
+            first_doc_offset = skip_tokens # tokens of the first document written before this batch
+            if skip_tokens:
+                tokens = tokens[skip_tokens:]
+                doc_lens[0] -= skip_tokens
+                skip_tokens = 0
+            doc_ends = np.cumsum(doc_lens)
+            pos = 0
+            while pos < len(tokens):
+                # fill the current shard with as much of the batch as fits
+                n = min(args.shard_size - token_count, len(tokens) - pos)
+                all_tokens_np[token_count:token_count+n] = tokens[pos:pos+n]
+                token_count += n
+                pos += n
+                # update progress bar
+                if progress_bar is None:
+                    progress_bar = tqdm(total=args.shard_size, unit="tokens", desc=f"Shard {shard_index}")
+                progress_bar.update(n)
+                if token_count == args.shard_size:
+                    # the next shard starts inside document d of this batch, after `skip` of its tokens
+                    d = int(np.searchsorted(doc_ends, pos, side="right"))
+                    skip = pos - (int(doc_ends[d-1]) if d > 0 else 0) + (first_doc_offset if d == 0 else 0)
+                    close_shard(args.shard_size, doc_index + d, skip)
+            doc_index += len(doc_lens)
+
+        # write any remaining tokens as the last shard
+        if token_count != 0:
+            close_shard(token_count, doc_index, 0)
+    writer.close()
+    manifest["complete"] = True
+    save_manifest(out_dir, manifest)
+
+if __name__ == "__main__":
+    main()
@@ -27,19 +27,21 @@ The validation set of HellaSwag has a total of 10,042 examples.
 
 import os
 import json
-import requests
 import tiktoken
-from tqdm import tqdm
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import GPT2LMHeadModel
+# requests, tqdm and transformers are imported where they are used (downloading, evaluating a
+# huggingface model), so the training loop can import the eval helpers without pulling them in
 
 # -----------------------------------------------------------------------------
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
 
 def download_file(url: str, fname: str, chunk_size=1024):
     """Helper function to download a file from a given url"""
+    import requests
+    from tqdm import tqdm
     resp = requests.get(url, stream=True)
     total = int(resp.headers.get("content-length", 0))
     with open(fname, "wb") as file, tqdm(
@@ -59,7 +61,13 @@ hellaswags = {
     "test": "https://raw.githubusercontent.com/rowanz/hellaswag/master/data/hellaswag_test.jsonl",
 }
 
-enc = tiktoken.get_encoding("gpt2")
+_enc = None
+def get_encoder():
+    # the GPT-2 BPE is loaded on first use, i.e. only when examples get tokenized
+    global _enc
+    if _enc is None:
+        _enc = tiktoken.get_encoding("gpt2")
+    return _enc
 
 def download(split):
     """Downloads HellaSwag DATA_CACHE_DIR"""
@@ -89,6 +97,7 @@ def render_example(example):
     }
 
     # gather up all the tokens
+    enc = get_encoder()
     ctx_tokens = enc.encode(ctx)
     data["ctx_tokens"] = ctx_tokens
     tok_rows = []
@@ -109,6 +118,124 @@ def render_example(example):
 
     return data, tokens, mask, label
 
+# pre-tokenized cache of a split, so evals after the first do no JSON parsing or tokenization
+# layout: int64 header [magic, version, num_examples, num_tokens]
+#         int64 offsets (5*num_examples+1,), segment k of example i is context (k=0) or ending k-1,
+#               and spans tokens[offsets[5*i+k] : offsets[5*i+k+1]]
+#         int64 labels (num_examples,)
+#         uint16 tokens (num_tokens,)
+CACHE_MAGIC = 20240911
+CACHE_VERSION = 1
+HEADER_SIZE = 4
+
+def cache_filename(split):
+    return os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}.bin")
+
+def compile_split(split):
+    """Tokenizes a split once and writes it to the binary cache file"""
+    offsets = [0]
+    labels = []
+    tokens = []
+    for example in iterate_examples(split):
+        data, _, _, _ = render_example(example)
+        for segment in [data["ctx_tokens"]] + data["ending_tokens"]:
+            tokens.extend(segment)
+            offsets.append(len(tokens))
+        labels.append(data["label"])
+    header = np.array([CACHE_MAGIC, CACHE_VERSION, len(labels), len(tokens)], dtype=np.int64)
+    filename = cache_filename(split)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp" # ddp ranks may compile concurrently
+    with open(tmp_filename, "wb") as f:
+        f.write(header.tobytes())
+        f.write(np.array(offsets, dtype=np.int64).tobytes())
+        f.write(np.array(labels, dtype=np.int64).tobytes())
+        f.write(np.array(tokens, dtype=np.uint16).tobytes())
+    os.replace(tmp_filename, filename) # never leave a half-written cache behind
+    print(f"wrote {len(labels)} examples, {len(tokens)} tokens to {filename}")
+
+def load_split(split):
+    """Memory-maps the cached split (compiling it on first use), returns (offsets, labels, tokens)"""
+    filename = cache_filename(split)
+    if not os.path.exists(filename):
+        compile_split(split)
+    header = np.fromfile(filename, dtype=np.int64, count=HEADER_SIZE)
+    assert header[0] == CACHE_MAGIC and header[1] == CACHE_VERSION, f"bad HellaSwag cache file {filename}, delete it to rebuild"
+    num_examples, num_tokens = int(header[2]), int(header[3])
+    start = HEADER_SIZE * 8
+    offsets = np.memmap(filename, dtype=np.int64, mode="r", offset=start, shape=(5*num_examples+1,))
+    start += offsets.nbytes
+    labels = np.memmap(filename, dtype=np.int64, mode="r", offset=start, shape=(num_examples,))
+    start += labels.nbytes
+    tokens = np.memmap(filename, dtype=np.uint16, mode="r", offset=start, shape=(num_tokens,))
+    return offsets, labels, tokens
+
+def collate_examples(cache, idx):
+    """
+    Packs the examples idx of a cached split (see load_split) into one padded batch:
+    - tokens (4*n, N), the 4 candidate rows of each example are contiguous
+    - mask (4*n, N), 1 in the completion region, 0 in the context and the right padding
+    - labels (n,)
+    Padding is on the right, so with a causal model it never changes the scores of the real tokens.
+    """
+    offsets, labels, tokens_np = cache
+    bounds = np.stack([offsets[5*i:5*i+6] for i in idx]) # (n, 6) segment boundaries
+    ctx_len = bounds[:, 1] - bounds[:, 0]
+    end_len = bounds[:, 2:] - bounds[:, 1:5] # (n, 4)
+    max_len = int((ctx_len[:, None] + end_len).max())
+    tokens = np.zeros((4*len(idx), max_len), dtype=np.int64)
+    mask = np.zeros((4*len(idx), max_len), dtype=np.int64)
+    for i, b in enumerate(bounds):
+        ctx = tokens_np[b[0]:b[1]]
+        for j in range(4):
+            row = 4*i + j
+            tokens[row, :ctx_len[i]] = ctx
+            tokens[row, ctx_len[i]:ctx_len[i]+end_len[i, j]] = tokens_np[b[j+1]:b[j+2]]
+            mask[row, ctx_len[i]:ctx_len[i]+end_len[i, j]] = 1
+    labels = torch.from_numpy(labels[idx].astype(np.int64))
+    return torch.from_numpy(tokens), torch.from_numpy(mask), labels
+
+def iterate_batches(split, batch_size=16, rank=0, world_size=1):
+    """
+    Yields (idx, tokens, mask, labels) batches of up to batch_size examples, see collate_examples.
+    idx holds the example indices in the split. Only the examples where i % world_size == rank are used,
+    and they are sorted by length first so that each batch packs similarly sized examples.
+    """
+    cache = load_split(split)
+    offsets = cache[0]
+    seg_len = np.diff(np.asarray(offsets)).reshape(-1, 5) # (num_examples, 5) context and ending lengths
+    example_len = seg_len[:, 0] + seg_len[:, 1:].max(axis=1)
+    mine = np.arange(rank, len(example_len), world_size)
+    order = mine[np.argsort(example_len[mine], kind="stable")]
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start+batch_size]
+        tokens, mask, labels = collate_examples(cache, idx)
+        yield idx, tokens, mask, labels
+
+def get_most_likely_rows(tokens, mask, logits):
+    """
+    Batched completion scoring for the output of collate_examples.
+    Takes tokens and mask (4*n, N) and logits (4*n, N, V), returns the per-candidate average
+    completion losses (n, 4) and the predicted index of each example by sum loss (acc) and
+    by average loss (acc_norm), each (n,).
+    """
+    # evaluate the autoregressive loss at all positions
+    shift_logits = (logits[..., :-1, :]).contiguous()
+    shift_tokens = (tokens[..., 1:]).contiguous()
+    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
+    flat_shift_tokens = shift_tokens.view(-1)
+    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
+    shift_losses = shift_losses.view(tokens.size(0), -1)
+    # now get the average loss just for the completion region (where mask == 1), in each row
+    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
+    masked_shift_losses = shift_losses * shift_mask
+    # sum and divide by the number of 1s in the mask
+    sum_loss = masked_shift_losses.sum(dim=1).view(-1, 4)
+    avg_loss = sum_loss / shift_mask.sum(dim=1).view(-1, 4)
+    # the completion with the lowest loss should be the most likely
+    pred = sum_loss.argmin(dim=1)
+    pred_norm = avg_loss.argmin(dim=1)
+    return avg_loss, pred, pred_norm
+
 def iterate_examples(split):
     # there are 10,042 examples in total in val
     download(split)
@@ -118,7 +245,8 @@ def iterate_examples(split):
             yield example
 
 @torch.no_grad()
-def evaluate(model_type, device):
+def evaluate(model_type, device, batch_size=16):
+    from transformers import GPT2LMHeadModel
 
     torch.set_float32_matmul_precision('high') # use tf32
     model = GPT2LMHeadModel.from_pretrained(model_type)
@@ -128,50 +256,44 @@ def evaluate(model_type, device):
     num_correct_norm = 0
     num_correct = 0
     num_total = 0
-    for example in iterate_examples("val"):
-        data, tokens, mask, label = render_example(example)
+    examples = None # the raw json is only needed for the debug printout below
+    for idx, tokens, mask, labels in iterate_batches("val", batch_size=batch_size):
         tokens = tokens.to(device)
         mask = mask.to(device)
+        labels = labels.to(device)
 
         # get the logits
         logits = model(tokens).logits
-        # evaluate the autoregressive loss at all positions
-        shift_logits = (logits[..., :-1, :]).contiguous()
-        shift_tokens = (tokens[..., 1:]).contiguous()
-        flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-        flat_shift_tokens = shift_tokens.view(-1)
-        shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-        shift_losses = shift_losses.view(tokens.size(0), -1)
-        # now get the average loss just for the completion region (where mask == 1), in each row
-        shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-        masked_shift_losses = shift_losses * shift_mask
-        # sum and divide by the number of 1s in the mask
-        sum_loss = masked_shift_losses.sum(dim=1)
-        avg_loss = sum_loss / shift_mask.sum(dim=1)
-        # now we have a loss for each of the 4 completions
-        # the one with the lowest loss should be the most likely
-        pred = sum_loss.argmin().item()
-        pred_norm = avg_loss.argmin().item()
+        # score all the completions of the batch at once
+        avg_loss, pred, pred_norm = get_most_likely_rows(tokens, mask, logits)
 
         # accumulate stats
-        num_total += 1
-        num_correct += int(pred == label)
-        num_correct_norm += int(pred_norm == label)
+        debug = num_total < 10
+        num_total += labels.size(0)
+        num_correct += (pred == labels).sum().item()
+        num_correct_norm += (pred_norm == labels).sum().item()
         print(f"{num_total} acc_norm: {num_correct_norm}/{num_total}={num_correct_norm/num_total:.4f}")
 
         # debug: pretty print a few examples, and the losses in each case
-        if num_total < 10:
-            print("---")
-            print(f"Context:\n {example['ctx']}")
-            print(f"Endings:")
-            for i, end in enumerate(example["endings"]):
-                print(f"{i} (loss: {avg_loss[i].item():.4f}) {end}")
-            print(f"predicted: {pred_norm}, actual: {label}")
+        if debug:
+            if examples is None:
+                examples = list(iterate_examples("val"))
+            for j, i_example in enumerate(idx[:10]):
+                example = examples[i_example]
+                print("---")
+                print(f"Context:\n {example['ctx']}")
+                print(f"Endings:")
+                for i, end in enumerate(example["endings"]):
+                    print(f"{i} (loss: {avg_loss[j, i].item():.4f}) {end}")
+                print(f"predicted: {pred_norm[j].item()}, actual: {labels[j].item()}")
+
+    print(f"{num_total} acc: {num_correct/num_total:.4f} acc_norm: {num_correct_norm/num_total:.4f}")
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="the model type to use")
     parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+    parser.add_argument("-b", "--batch_size", type=int, default=16, help="examples per forward (4 rows each)")
     args = parser.parse_args()
-    evaluate(args.model_type, args.device)
\ No newline at end of file
+    evaluate(args.model_type, args.device, args.batch_size)
\ No newline at end of file
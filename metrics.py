@@ -0,0 +1,154 @@
+"""
+Lightweight training-step instrumentation:
+- StepTimer: wall time per phase of a step (data, forward, backward, ...), synchronizing the device
+  at phase boundaries only when enabled, so the default training loop pays nothing for it
+- peak memory, model FLOPs per token and MFU (model FLOPs utilization) from the GPTConfig
+- MetricsLogger: one JSON object per line, easy to load with pandas or jq
+- truncate_log: cuts a log back to a resumed step, so the steps run again are not logged twice
+- ProfilerHook: wraps a chosen range of steps in torch.profiler and writes a chrome trace
+- compile_stats: how many times torch.compile compiled and recompiled, and the time it took
+"""
+
+import os
+import json
+import time
+import importlib
+import resource
+from contextlib import contextmanager
+from collections import defaultdict
+import torch
+
+# -----------------------------------------------------------------------------
+
+class StepTimer:
+
+    def __init__(self, device_type, enabled=False):
+        self.device_type = device_type
+        self.enabled = enabled
+        self.times = defaultdict(float) # phase name -> seconds, since the last reset()
+
+    def _sync(self):
+        if self.device_type == "cuda":
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync() # don't charge this phase for kernels still queued by the previous one
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self.times[name] += time.perf_counter() - t0
+
+    def reset(self):
+        # returns the phase times (in ms) accumulated since the last reset, and starts over
+        phases = {name: 1000 * t for name, t in self.times.items()}
+        self.times.clear()
+        return phases
+
+def peak_memory(device_type):
+    # peak allocated device memory on CUDA (then reset for the next step), peak RSS of the process on CPU
+    if device_type == "cuda":
+        peak = torch.cuda.max_memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # ru_maxrss is in KiB on Linux
+
+def flops_per_token(config, num_params, T):
+    # training FLOPs per token, see the PaLM paper Appendix B: 6N for the matmuls of the forward and
+    # backward passes, plus 12*L*H*Q*T for attention (the scores and the weighted sum)
+    L, H, Q = config.n_layer, config.n_head, config.n_embd // config.n_head
+    return 6 * num_params + 12 * L * H * Q * T
+
+def estimate_mfu(config, num_params, T, tokens_per_sec, peak_flops):
+    # achieved model FLOPs per second as a fraction of the hardware peak (None if the peak is unknown)
+    if not peak_flops:
+        return None
+    return flops_per_token(config, num_params, T) * tokens_per_sec / peak_flops
+
+def compile_stats():
+    # cumulative torch.compile activity of this process. A function is recompiled when the guards of all its
+    # compiled versions fail, e.g. on a new input shape or grad mode; each compile adds to compile_s.
+    # These are torch._dynamo internals: whatever a torch version doesn't have is reported as "n/a".
+    def lookup(module, name):
+        try:
+            return getattr(importlib.import_module(module), name, None)
+        except ImportError:
+            return None
+    counters = lookup("torch._dynamo.utils", "counters")
+    compilation_time_metrics = lookup("torch._dynamo.utils", "compilation_time_metrics")
+    frame_compile_counter = lookup("torch._dynamo.convert_frame", "FRAME_COMPILE_COUNTER") # compiles per function
+    stats = {"compiles": "n/a", "recompiles": "n/a", "graphs": "n/a", "compile_s": "n/a"}
+    try:
+        if counters is not None:
+            stats["compiles"] = counters["frames"]["ok"]
+            stats["graphs"] = counters["stats"]["unique_graphs"]
+        if frame_compile_counter is not None:
+            stats["recompiles"] = sum(n - 1 for n in frame_compile_counter.values() if n > 1)
+        if compilation_time_metrics is not None:
+            stats["compile_s"] = round(float(sum(compilation_time_metrics.get("_compile.compile_inner", []))), 3)
+    except (TypeError, KeyError, AttributeError):
+        pass # a changed layout, keep what was read so far
+    return stats
+
+def format_compile_stats(stats):
+    compile_s = f"{stats['compile_s']:.1f}s" if isinstance(stats['compile_s'], float) else stats['compile_s']
+    return f"{stats['compiles']} compiles ({stats['recompiles']} recompiles), {stats['graphs']} graphs, {compile_s} compiling"
+
+def truncate_log(filename, step):
+    """
+    Drops the records of steps >= step from a log, which the resumed run is about to write again: both
+    log.txt ("{step} {kind} {value}" lines) and metrics.jsonl (JSON objects with a "step") are understood.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        lines = f.readlines()
+    def line_step(line):
+        return json.loads(line)["step"] if line.startswith("{") else int(line.split()[0])
+    kept = [line for line in lines if line.strip() and line_step(line) < step]
+    tmp_filename = filename + f".tmp{os.getpid()}"
+    with open(tmp_filename, "w") as f:
+        f.writelines(kept)
+    os.replace(tmp_filename, filename)
+
+class MetricsLogger:
+
+    def __init__(self, filename, enabled=True, append=False):
+        self.enabled = enabled
+        if enabled:
+            self.f = open(filename, "a" if append else "w") # a fresh run clears the file, a resumed one appends
+
+    def log(self, **record):
+        if self.enabled:
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+
+class ProfilerHook:
+    """Profiles steps [start_step, start_step + num_steps) and writes the chrome trace to out_dir"""
+
+    def __init__(self, out_dir, start_step=-1, num_steps=0, device_type="cpu"):
+        self.out_dir = out_dir
+        self.start_step = start_step
+        self.end_step = start_step + num_steps
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device_type == "cuda":
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+
+    def step_begin(self, step):
+        if step == self.start_step and self.end_step > self.start_step:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True, with_stack=False)
+            self.profiler.start()
+
+    def step_end(self, step):
+        if self.profiler is not None and step == self.end_step - 1:
+            self.profiler.stop()
+            trace_file = os.path.join(self.out_dir, f"trace_steps_{self.start_step:05d}_{self.end_step:05d}.json")
+            self.profiler.export_chrome_trace(trace_file)
+            print(f"wrote profiler trace to {trace_file}")
+            self.profiler = None
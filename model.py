@@ -0,0 +1,731 @@
+"""
+The GPT-2 model, importable on its own (without kicking off training) for inference tools.
+"""
+
+import os
+import glob
+import json
+import pickle
+import struct
+import hashlib
+import inspect
+from dataclasses import dataclass, asdict
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+### 아래와 같은 약 100줄의 코드로 기존에 약 2천줄에 달하는 코드를 간소화시켰다
+# https://github.com/huggingface/transformers/blob/main/src/transformers/models/gpt2/modeling_gpt2.py
+class CausalSelfAttention(nn.Module): ### Andrej Karpathy의 다른 강의에서 보였던 Head를 Multi-Head Attention으로 구현한 것을, pytorch에서의 연산 효율성을 위해 하나의 모듈로 재구성한 것일 뿐임. 본질적으로 같다.
+
+    def __init__(self, config):
+        super().__init__()
+        assert config.n_embd % config.n_head == 0
+        # key, query, value projections for all heads, but in a batch
+        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
+        # output projection
+        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1
+        # regularization
+        self.n_head = config.n_head
+        self.n_embd = config.n_embd
+        # not really a 'bias', more of a mask, but following the OpenAI/HF naming though
+        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
+                             .view(1, 1, config.block_size, config.block_size))
+
+    def forward(self, x, kv_cache=None, layer=None):
+        B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
+        # calculate query, key, values for all heads in batch and move head forward to be the batch
+        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
+        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the transformer
+        qkv = self.c_attn(x)
+        q, k, v =qkv.split(self.n_embd, dim=2)
+        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+
+        if kv_cache is None:
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=True) ### 최적화 #4
+        else:
+            # incremental decoding: the new queries attend to the cached keys/values plus their own
+            attn_mask, is_causal = kv_cache.attention_args(T)
+            k, v = kv_cache.update(layer, k, v) # (B, nh, past+T, hs)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=is_causal)
+        # attention (materializes the large (T,T) matrix for all the queries and keys)
+        
+        # att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) ### q,k간에 상호 얼마나 참조하는지 파악
+        # att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf')) ### autoregressive mask를 적용하여, 과거의 데이터만 보게 만들고,
+        # att = F.softmax(att, dim=-1) ### SoftMax로 1로 normalize시키고
+        # y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs) ### Weighted Sum 을 계산하고,
+
+        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side ##Concatenation 연산에 해당
+        # output projection
+        y = self.c_proj(y)
+        return y
+
+class MLP(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        self.c_fc   = nn.Linear(config.n_embd, 4 * config.n_embd)
+        self.gelu   = nn.GELU(approximate='tanh') ### 초창기 tensorflow에서 erf속도가 너무 느려서 tanh로 GELU를 approximation하는 것을 만들었음. 지금은 gelu자체에 속도 이슈가 없어서 approximation을 사용할 이유가 없으나, 최대한 GPT-2에 근접하게 만드는 것이 오늘 강의의 목표이므로, approximation을 사용했음. ### 그리고, relu대신 gelu를 사용하면 0 근처에서의 학습 데이터를 계속해서 사용할 수 있는 강점이 있기 때문. 최근에는 gelu 이후 다른 함수들을 많이 쓰고 있지만, 같은 이유로 오늘은 gelu를 사용한다.
+        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1
+
+
+    def forward(self, x):
+        x = self.c_fc(x)
+        x = self.gelu(x)
+        x = self.c_proj(x)
+        return x
+
+RECOMPUTE_MODES = ("none", "block", "attn", "mlp")
+
+class Block(nn.Module):
+
+    def __init__(self, config, recompute="none"):
+        super().__init__()
+        self.ln_1 = nn.LayerNorm(config.n_embd)
+        self.attn = CausalSelfAttention(config)
+        self.ln_2 = nn.LayerNorm(config.n_embd)
+        self.mlp = MLP(config)
+        assert recompute in RECOMPUTE_MODES, f"recompute must be one of {RECOMPUTE_MODES}"
+        self.recompute = recompute
+
+    def forward(self, x, kv_cache=None, layer=None): # Residual한 Path를 깔끔하게 내려주는 것이 0.기본문서보다 더 동작을 잘 하게 만들 수 있다.
+        if self.recompute != "none" and self.training and torch.is_grad_enabled():
+            return self.forward_recompute(x)
+        x = x + self.attn(self.ln_1(x), kv_cache, layer) ## 어텐션은 커뮤니케이션 연산에 해당. 1024개 토큰끼리 상호 작용이 활발하게 일어나기 때문에, aggregation,pooling,weighted sum,reduce라고 볼 수 있고,
+        x = x + self.mlp(self.ln_2(x)) ## MLP는 모든 토큰이 개별적으로 연산되고, 토큰 간의 연산은 없음. 따라서, 윗 줄의 attn은 REDUCE, 이 줄의 mlp는 MAP에 해당한다고도 볼 수 있다. 즉, Transformer는 Map Reduce의 반복이라고도 볼 수 있음.
+        return x
+
+    def forward_recompute(self, x):
+        # activation checkpointing: only the input of the recomputed part is kept for backward, its
+        # intermediate activations (qkv, attention output, the 4*n_embd MLP hidden, ...) are recomputed
+        # from it during backward, i.e. one extra forward of that part for a fraction of the memory
+        attn = lambda x: x + self.attn(self.ln_1(x))
+        mlp = lambda x: x + self.mlp(self.ln_2(x))
+        ckpt = lambda f, x: checkpoint(f, x, use_reentrant=False)
+        if self.recompute == "block":
+            return ckpt(lambda x: mlp(attn(x)), x)
+        if self.recompute == "attn":
+            return mlp(ckpt(attn, x))
+        return ckpt(mlp, attn(x)) # "mlp"
+
+@dataclass
+class GPTConfig: ### huggingface에 올라온 gpt2 124M모델과 hyperparameter를 맞췄음.
+    block_size: int = 1024 # max sequence length
+    vocab_size: int = 50257 # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|>
+    n_layer: int = 12 # number of layers
+    n_head: int = 12 # number of heads
+    n_embd: int = 768 # embedding dimension
+    recompute: str = "none" # activation recomputation in training: none, block, attn (attention only) or mlp (MLP only)
+    recompute_every: int = 1 # recompute in every k-th block only (blocks 0, k, 2k, ...)
+
+class KVCache:
+    """
+    Per-layer key/value cache for incremental decoding.
+    Buffers are (n_layer, B, nh, max_len, hs) and allocated lazily on the first update,
+    so they pick up the dtype the attention runs in (e.g. bfloat16 under autocast).
+    pos is the number of positions already cached; it is advanced by GPT.forward, and can be
+    set back to drop the tail of the cache.
+    A cache object provides positions/attention_args/update/advance, which is all GPT.forward
+    and CausalSelfAttention rely on, so other layouts (e.g. per-row lengths) can be swapped in.
+    """
+
+    def __init__(self, config, batch_size, max_len=None):
+        self.n_layer = config.n_layer
+        self.batch_size = batch_size
+        self.max_len = max_len or config.block_size
+        self.k = None
+        self.v = None
+        self.pos = 0
+
+    def positions(self, T, device):
+        return torch.arange(self.pos, self.pos + T, dtype=torch.long, device=device) # shape (T)
+
+    def attention_args(self, T):
+        # (attn_mask, is_causal) for T new queries at positions pos..pos+T-1
+        if self.pos == 0:
+            return None, True # plain causal attention over the new tokens
+        if T == 1:
+            return None, False # a single new query may attend to every cached position
+        mask = torch.ones(T, self.pos + T, dtype=torch.bool, device=self.k.device).tril(diagonal=self.pos)
+        return mask, False
+
+    def update(self, layer, k, v):
+        B, nh, T, hs = k.size()
+        if self.k is None:
+            shape = (self.n_layer, B, nh, self.max_len, hs)
+            self.k = torch.empty(shape, dtype=k.dtype, device=k.device)
+            self.v = torch.empty(shape, dtype=v.dtype, device=v.device)
+        assert self.pos + T <= self.max_len, f"KV cache overflow: {self.pos + T} > {self.max_len}"
+        self.k[layer, :, :, self.pos:self.pos+T] = k
+        self.v[layer, :, :, self.pos:self.pos+T] = v
+        return self.k[layer, :, :, :self.pos+T], self.v[layer, :, :, :self.pos+T]
+
+    def advance(self, T):
+        self.pos += T
+
+class PaddedKVCache(KVCache):
+    """
+    KVCache for a batch of prompts of different lengths, left-padded to a common length so that the next
+    token of every row lands in the same column: row b starts with pad[b] padding positions, which are
+    never attended to and don't count towards the row's positions.
+    select(rows) keeps only the given rows, e.g. to drop the finished sequences from a batch.
+    """
+
+    def __init__(self, config, pad, max_len=None):
+        super().__init__(config, len(pad), max_len)
+        self.pad = pad # (B,) padding positions per row
+
+    def positions(self, T, device):
+        pos = torch.arange(self.pos, self.pos + T, dtype=torch.long, device=device)
+        return (pos[None, :] - self.pad[:, None]).clamp(min=0) # (B, T), each row counts from its first real token
+
+    def attention_args(self, T):
+        L = self.pos + T
+        cols = torch.arange(L, device=self.pad.device)
+        rows = torch.arange(self.pos, L, device=self.pad.device)
+        mask = (cols[None, None, :] <= rows[None, :, None]) & (cols[None, None, :] >= self.pad[:, None, None]) # (B, T, L)
+        # a padding query attends to itself only: a fully masked row would turn into NaNs
+        mask |= cols[None, None, :] == rows[None, :, None]
+        return mask.unsqueeze(1), False # (B, 1, T, L), broadcast over the heads
+
+    def select(self, rows):
+        self.k = self.k[:, rows]
+        self.v = self.v[:, rows]
+        self.pad = self.pad[rows]
+        self.batch_size = len(self.pad)
+
+def sample(logits, temperature, top_k, top_p=None, generator=None):
+    """
+    Samples one token per row from (B, V) logits with per-row temperature (B,), top_k (B,) and top_p (B,).
+    top_k 0 means no top-k cut, top_p 1 (or None for all rows) no nucleus cut, temperature 0 means greedy.
+    """
+    V = logits.size(-1)
+    greedy = temperature <= 0
+    top_k = torch.where(greedy, torch.ones_like(top_k), torch.where(top_k > 0, top_k, torch.full_like(top_k, V)))
+    temperature = torch.where(greedy, torch.ones_like(temperature), temperature)
+    probs = F.softmax(logits.float() / temperature[:, None], dim=-1)
+    k_max = int(top_k.max())
+    topk_probs, topk_indices = torch.topk(probs, k_max, dim=-1) # sorted, most likely first
+    # rows with a smaller top_k drop their tail; multinomial does not demand the input to sum to 1
+    topk_probs = topk_probs.masked_fill(torch.arange(k_max, device=probs.device)[None, :] >= top_k[:, None], 0.0)
+    if top_p is not None:
+        # nucleus: the most likely tokens until their share of the (top-k) probability mass reaches top_p
+        cum_probs = topk_probs.cumsum(dim=-1)
+        topk_probs = topk_probs.masked_fill(cum_probs - topk_probs >= top_p[:, None] * cum_probs[:, -1:], 0.0)
+    ix = torch.multinomial(topk_probs, 1, generator=generator) # (B, 1)
+    return torch.gather(topk_indices, -1, ix) # (B, 1)
+
+# rows (B*T positions) per chunk of the fused lm_head + cross-entropy: a chunk's logits are
+# LOSS_CHUNK_SIZE x vocab_size, e.g. 2048 x 50304 fp32 = 412MB instead of 6.6GB for B=32, T=1024
+LOSS_CHUNK_SIZE = 2048
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy of the logits x @ weight.T against targets, chunk_size rows at a time, so the
+    (N, vocab_size) logits and their gradient never exist in full. The gradients are computed chunk by
+    chunk in the forward pass already (softmax - one_hot is all the backward needs from the logits),
+    which costs the same three matmuls as lm_head + F.cross_entropy and their backward.
+    With reduction="none" it returns the (N,) per-token losses instead. Their gradients depend on the
+    incoming per-token grad_output, so then the backward recomputes the logits chunk by chunk from x,
+    weight and the saved logsumexp of every row (one more matmul, still no full logits).
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size, compute_grad, reduction="mean"):
+        N = x.size(0)
+        assert reduction in ("mean", "none")
+        losses = torch.empty(N, dtype=torch.float32, device=x.device)
+        ctx.chunk_size = chunk_size
+        ctx.recompute = compute_grad and reduction == "none"
+        if ctx.recompute:
+            lses = torch.empty(N, dtype=torch.float32, device=x.device)
+            compute_grad = False # the gradients are computed in backward instead
+        grad_x = torch.empty_like(x) if compute_grad else None
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if compute_grad else None
+        for i in range(0, N, chunk_size):
+            xc, tc = x[i:i+chunk_size], targets[i:i+chunk_size]
+            logits = (xc @ weight.t()).float() # (n, vocab_size), the softmax runs in fp32 as in F.cross_entropy
+            lse = torch.logsumexp(logits, dim=-1)
+            losses[i:i+chunk_size] = lse - logits.gather(1, tc.unsqueeze(1)).squeeze(1)
+            if ctx.recompute:
+                lses[i:i+chunk_size] = lse
+            if compute_grad:
+                # d(mean loss)/d(logits) = (softmax(logits) - one_hot(targets)) / N, in place over the logits
+                dlogits = logits.sub_(lse.unsqueeze(1)).exp_()
+                dlogits[torch.arange(tc.size(0), device=tc.device), tc] -= 1
+                dlogits = dlogits.div_(N).to(x.dtype)
+                grad_x[i:i+chunk_size] = dlogits @ weight
+                grad_weight += dlogits.t() @ xc
+        if ctx.recompute:
+            ctx.save_for_backward(x, weight, targets, lses)
+        elif compute_grad:
+            ctx.save_for_backward(grad_x, grad_weight.to(weight.dtype))
+        return losses.mean() if reduction == "mean" else losses
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if not ctx.recompute:
+            grad_x, grad_weight = ctx.saved_tensors
+            return grad_x * grad_output, grad_weight * grad_output, None, None, None, None
+        # reduction="none": d(loss_i)/d(logits_i) = softmax(logits_i) - one_hot(target_i), scaled by grad_output[i]
+        x, weight, targets, lses = ctx.saved_tensors
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device)
+        for i in range(0, x.size(0), ctx.chunk_size):
+            xc, tc = x[i:i+ctx.chunk_size], targets[i:i+ctx.chunk_size]
+            dlogits = (xc @ weight.t()).float().sub_(lses[i:i+ctx.chunk_size].unsqueeze(1)).exp_()
+            dlogits[torch.arange(tc.size(0), device=tc.device), tc] -= 1
+            dlogits = dlogits.mul_(grad_output[i:i+ctx.chunk_size].unsqueeze(1)).to(x.dtype)
+            grad_x[i:i+ctx.chunk_size] = dlogits @ weight
+            grad_weight += dlogits.t() @ xc
+        return grad_x, grad_weight.to(weight.dtype), None, None, None, None
+
+def chunked_cross_entropy(x, weight, targets, chunk_size=LOSS_CHUNK_SIZE, reduction="mean"):
+    # same loss and gradients as F.cross_entropy(F.linear(x, weight).view(-1, V), targets.view(-1)), under autocast too;
+    # reduction="none" gives the per-token losses in the shape of targets
+    device_type = x.device.type
+    if torch.is_autocast_enabled(device_type):
+        # the projection runs in the autocast dtype, like lm_head would; the casts carry the gradients back
+        dtype = torch.get_autocast_dtype(device_type)
+        x, weight = x.to(dtype), weight.to(dtype)
+    compute_grad = torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad)
+    with torch.autocast(device_type=device_type, enabled=False):
+        loss = ChunkedLinearCrossEntropy.apply(x.reshape(-1, x.size(-1)), weight, targets.reshape(-1), chunk_size, compute_grad, reduction)
+    return loss if reduction == "mean" else loss.view(targets.shape)
+
+class GPT(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+
+        self.transformer = nn.ModuleDict(dict(
+            wte = nn.Embedding(config.vocab_size, config.n_embd), # Figure 1.에서는 Output Embedding이라고 적혀있지만, 그것이 여기서는 Token Embedding (wte)에 해당
+            wpe = nn.Embedding(config.block_size, config.n_embd),
+            h = nn.ModuleList([Block(config, config.recompute if i % config.recompute_every == 0 else "none") for i in range(config.n_layer)]), 
+            ln_f = nn.LayerNorm(config.n_embd), #Layer normalization 은 각 블록의 뒤로 옮겨졌다. #Layer normalization (Ba et al., 2016) was moved to the input of each sub-block, similar to a pre-activation residual network
+        ))
+        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False) #an additional layer normalization was added after the final self attention block.
+
+        ## weight sharing scheme
+        self.transformer.wte.weight = self.lm_head.weight
+
+        # init params
+        self.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        if isinstance(module, nn.Linear):
+            std = 0.02
+            if hasattr(module, 'NANOGPT_SCALE_INIT'):
+                std *= (2 * self.config.n_layer) ** -0.5 ##
+            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
+            if module.bias is not None:
+                torch.nn.init.zeros_(module.bias)
+        elif isinstance(module, nn.Embedding):
+            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
+
+    def forward(self, idx, targets=None, kv_cache=None, last_only=False, return_logits=True, reduction="mean"): ## 인풋은 항상 인덱스인데, 'token'의 인덱스들임. BxT사이즈
+        # idx is of shape (B, T) ## T는 타임, T개의 token이 존재함. idx는 항상 BxT이다!
+        # with a kv_cache, idx holds only the new tokens, which sit after kv_cache.pos cached positions
+        # with targets and return_logits=False only the loss is computed, chunk by chunk, and logits is None
+        # reduction="none" returns the (B, T) per-token losses instead of their mean
+        B, T = idx.size()
+        past = kv_cache.pos if kv_cache is not None else 0
+        assert past + T <= self.config.block_size, f"Cannot forward sequence of length {past + T}, block size is only {self.config.block_size}"
+        # forward the token and position embeddings
+        if kv_cache is not None:
+            pos = kv_cache.positions(T, idx.device)
+        else:
+            pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (T, n_embd), or (B, T, n_embd) with per-row positions
+        tok_emb = self.transformer.wte(idx) # token embeddings of shape (B, T, n_embd)
+        x = tok_emb + pos_emb
+        # forward the blocks of the transformer
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, i)
+        if kv_cache is not None:
+            kv_cache.advance(T)
+        # forward the final layernorm and the classifier
+        x = self.transformer.ln_f(x)
+        if last_only:
+            # inference: only the next-token distribution is needed, skip lm_head on the other T-1 positions
+            x = x[:, [-1], :]
+        if targets is not None and not return_logits and type(self.lm_head) is nn.Linear:
+            # training/val loss: the tied lm_head and the cross-entropy fused and chunked over the B*T positions,
+            # so the (B, T, vocab_size) logits, the largest tensor of the step, are never materialized
+            # (only for a plain float lm_head; e.g. quantize.py's Int8Linear has to run as a module)
+            return None, chunked_cross_entropy(x, self.lm_head.weight, targets, reduction=reduction)
+        logits = self.lm_head(x) # (B, T, vocab_size)
+        loss = None
+        if targets is not None:
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), reduction=reduction) ## Cross_Entropy는 2차원을 인풋으로 받지 못하기 때문에 BxT를 flatten시키는 작업이 필요했다. (B*T, voab_size)
+            if reduction == "none":
+                loss = loss.view(targets.shape)
+        if targets is not None and not return_logits:
+            logits = None # as from the fused path
+        return logits, loss
+
+    @classmethod
+    def from_pretrained(cls, model_type):
+        """Loads pretrained GPT-2 model weights from huggingface"""
+        assert model_type in GPT2_CONFIGS
+        # already downloaded: straight from its model.safetensors, see load_pretrained
+        snapshot = find_hf_snapshot(model_type)
+        if snapshot is not None:
+            model = load_pretrained(snapshot)
+            model.train() # like the model built below
+            return model
+        from transformers import GPT2LMHeadModel
+        print("loading weights from pretrained gpt: %s" % model_type)
+
+        # n_layer, n_head and n_embd are determined from model_type
+        config_args = dict(GPT2_CONFIGS[model_type])
+        config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
+        config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
+        # create a from-scratch initialized minGPT model
+        config = GPTConfig(**config_args)
+        model = GPT(config)
+        sd = model.state_dict()
+        sd_keys = sd.keys()
+        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
+
+        # init a huggingface/transformers model
+        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
+        sd_hf = model_hf.state_dict()
+
+        # copy while ensuring all of the parameters are aligned and match in names and shapes
+        sd_keys_hf = sd_hf.keys()
+        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
+        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
+        transposed = CONV1D_WEIGHTS
+        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
+        # this means that we have to transpose these weights when we import them
+        assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
+        for k in sd_keys_hf:
+            if any(k.endswith(w) for w in transposed):
+                # special treatment for the Conv1D weights we need to transpose
+                assert sd_hf[k].shape[::-1] == sd[k].shape
+                with torch.no_grad():
+                    sd[k].copy_(sd_hf[k].t())
+            else:
+                # vanilla copy over the other parameters
+                assert sd_hf[k].shape == sd[k].shape
+                with torch.no_grad():
+                    sd[k].copy_(sd_hf[k])
+
+        return model
+    
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=50, generator=None):
+        """
+        Sample max_new_tokens tokens after the (B, T) prompt idx and return the (B, T+max_new_tokens) sequence.
+        The prompt is forwarded once to fill a KVCache, then every step forwards only the newest token.
+        """
+        B, T = idx.size()
+        assert T + max_new_tokens <= self.config.block_size, f"Cannot generate {T + max_new_tokens} tokens, block size is only {self.config.block_size}"
+        kv_cache = KVCache(self.config, B, max_len=T + max_new_tokens)
+        logits, _ = self(idx, kv_cache=kv_cache, last_only=True) # prefill
+        out = [idx]
+        for i in range(max_new_tokens):
+            # take the logits at the last position
+            logits = logits[:, -1, :] / temperature # (B, vocab_size)
+            # get the probabilities
+            probs = F.softmax(logits.float(), dim=-1)
+            if top_k is not None:
+                # do top-k sampling (huggingface pipeline default is 50)
+                topk_probs, topk_indices = torch.topk(probs, min(top_k, probs.size(-1)), dim=-1)
+                # select a token from the top-k probabilities
+                # note: multinomial does not demand the input to sum to 1
+                ix = torch.multinomial(topk_probs, 1, generator=generator) # (B, 1)
+                # gather the corresponding indices
+                xcol = torch.gather(topk_indices, -1, ix) # (B, 1)
+            else:
+                xcol = torch.multinomial(probs, 1, generator=generator) # (B, 1)
+            out.append(xcol)
+            if i < max_new_tokens - 1:
+                # decode: forward just the new token against the cache
+                logits, _ = self(xcol, kv_cache=kv_cache, last_only=True)
+        return torch.cat(out, dim=1)
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=50, top_p=1.0, stop=(), eot=50256, generator=None):
+        """
+        Samples a completion for each of a list of prompts (lists of token ids, of any lengths), in one batch.
+        temperature, top_k and top_p are given per prompt (lists) or for all of them; see sample.
+        A row finishes on eot (None: never), when its completion ends with one of the stop sequences (lists of
+        token ids) or after max_new_tokens tokens. Finished rows leave the batch, so every decode step only
+        forwards the running ones. Returns the completions, without the eot or stop sequence that ended them.
+        """
+        B = len(prompts)
+        device = self.lm_head.weight.device
+        prompt_lens = [len(p) for p in prompts]
+        P = max(prompt_lens)
+        assert min(prompt_lens) > 0, "empty prompt"
+        assert P + max_new_tokens <= self.config.block_size, f"Cannot generate {P + max_new_tokens} tokens, block size is only {self.config.block_size}"
+        idx = torch.zeros(B, P, dtype=torch.long)
+        for b, p in enumerate(prompts):
+            idx[b, P-len(p):] = torch.tensor(p, dtype=torch.long)
+        per_row = lambda v, dtype: torch.tensor(v if isinstance(v, (list, tuple)) else [v] * B, dtype=dtype, device=device)
+        temperature, top_k, top_p = per_row(temperature, torch.float32), per_row(top_k, torch.long), per_row(top_p, torch.float32)
+        stop = [list(s) for s in stop]
+        out = torch.zeros(B, max_new_tokens, dtype=torch.long) # the completions are written here, row by row
+        lengths = [max_new_tokens] * B # the length of each completion, set when it finishes
+        active = list(range(B)) # the prompt each row of the running batch belongs to
+        kv_cache = PaddedKVCache(self.config, torch.tensor([P - l for l in prompt_lens], device=device), max_len=P + max_new_tokens)
+        logits, _ = self(idx.to(device), kv_cache=kv_cache, last_only=True) # prefill
+        for i in range(max_new_tokens):
+            xcol = sample(logits[:, -1, :], temperature, top_k, top_p, generator) # (b, 1)
+            tokens = xcol.view(-1).tolist()
+            out[active, i] = torch.tensor(tokens)
+            keep = []
+            for j, (b, token) in enumerate(zip(active, tokens)):
+                n = i + 1 # tokens generated so far in row b
+                ended = [len(s) for s in stop if len(s) <= n and out[b, n-len(s):n].tolist() == s]
+                if token == eot:
+                    lengths[b] = i
+                elif ended:
+                    lengths[b] = n - max(ended)
+                else:
+                    keep.append(j)
+            if not keep or i == max_new_tokens - 1:
+                break
+            if len(keep) < len(active):
+                # drop the finished rows from the batch, cache and sampling parameters included
+                rows = torch.tensor(keep, device=device)
+                kv_cache.select(rows)
+                xcol, temperature, top_k, top_p = xcol[rows], temperature[rows], top_k[rows], top_p[rows]
+                active = [active[j] for j in keep]
+            # decode: forward just the new token of every running row against the cache
+            logits, _ = self(xcol, kv_cache=kv_cache, last_only=True)
+        return [out[b, :lengths[b]].tolist() for b in range(B)]
+
+    def configure_optimizers(self, weight_decay, learning_rate, device_type, shard="none"):
+        # start with all of the candidate parameters (that require grad)
+        param_dict = {pn: p for pn, p in self.named_parameters()}
+        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
+        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no. 
+        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
+        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2]
+        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2]
+        optim_groups = [
+            {'params': decay_params, 'weight_decay': weight_decay},
+            {'params': nodecay_params, 'weight_decay': 0.0}
+        ]
+        num_decay_params = sum(p.numel() for p in decay_params)
+        num_nodecay_params = sum(p.numel() for p in nodecay_params)
+        print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
+        print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
+        # Create AdamW optimizer and use the fused version if it is available
+        fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
+        use_fused = fused_available and device_type == 'cuda'
+        print(f"using fused AdamW: {use_fused}")
+        if shard != "none":
+            # ZeRO: the AdamW state is partitioned over the ranks of the (initialized) process group, see zero.py
+            from zero import sharded_adamw
+            return sharded_adamw(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
+        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
+        return optimizer
+
+# n_layer, n_head and n_embd of the OpenAI GPT-2 checkpoints
+GPT2_CONFIGS = {
+    'gpt2':         dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
+    'gpt2-medium':  dict(n_layer=24, n_head=16, n_embd=1024), # 350M params
+    'gpt2-large':   dict(n_layer=36, n_head=20, n_embd=1280), # 774M params
+    'gpt2-xl':      dict(n_layer=48, n_head=25, n_embd=1600), # 1558M params
+}
+# the weights the OpenAI checkpoints keep as (in, out) for their Conv1D modules, where nn.Linear wants (out, in)
+CONV1D_WEIGHTS = ('attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight')
+SAFETENSORS_DTYPES = {"F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16, "U8": torch.uint8, "BOOL": torch.bool}
+# load_pretrained's transposed copies of the checkpoints it reads: in the user's cache, not in the checkout
+# or in the huggingface cache, which belong to someone else; GPT2_CACHE_DIR overrides it
+PRETRAINED_CACHE_DIR = os.environ.get("GPT2_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "gpt2_124M")
+
+def build_model(config, state_dict, device="cpu"):
+    """
+    An eval-mode GPT around the tensors of state_dict, without the random init that they would overwrite:
+    the GPT is created on the meta device and load_state_dict(assign=True) adopts the tensors instead of
+    copying them, so memory-mapped ones stay mapped (on CPU) and are only read as they are used.
+    """
+    with torch.device("meta"):
+        model = GPT(config)
+    # the causal mask buffers (unused, attention is causal by itself) if the state dict has none: one copy for all layers
+    mask = None
+    for i in range(config.n_layer):
+        if f'transformer.h.{i}.attn.bias' not in state_dict:
+            if mask is None:
+                mask = torch.tril(torch.ones(config.block_size, config.block_size)).view(1, 1, config.block_size, config.block_size)
+            state_dict = {**state_dict, f'transformer.h.{i}.attn.bias': mask}
+    model.load_state_dict(state_dict, assign=True)
+    model.lm_head.weight = model.transformer.wte.weight # assign made two parameters out of the tied weight
+    model.to(device)
+    model.eval()
+    return model
+
+def read_safetensors(path):
+    """
+    The tensors of a .safetensors file as CPU tensors backed by a copy-on-write memory map of it, and the
+    string metadata of its header. Nothing is read from disk before it is used, and processes mapping the
+    same file share its pages in the page cache. The format is the length of a JSON header (8 bytes, little
+    endian), the header, with the dtype, shape and byte range of every tensor, then the data; no safetensors
+    package needed.
+    """
+    with open(path, "rb") as f:
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    data = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_len))
+    metadata = header.pop("__metadata__", {})
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        tensors[name] = data[begin:end].view(SAFETENSORS_DTYPES[info["dtype"]]).view(info["shape"])
+    return tensors, metadata
+
+def write_safetensors(path, tensors, metadata=None):
+    # the inverse of read_safetensors; written to a temporary file and renamed, so path is complete or absent
+    dtype_names = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+    header = {"__metadata__": metadata} if metadata else {}
+    offset = 0
+    for name, t in tensors.items():
+        header[name] = {"dtype": dtype_names[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + t.nbytes]}
+        offset += t.nbytes
+    header = json.dumps(header).encode()
+    header += b" " * (-len(header) % 8) # the data starts 8-byte aligned
+    tmp_path = path + f".tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for t in tensors.values():
+            f.write(t.detach().contiguous().cpu().view(torch.uint8).numpy().data)
+    os.replace(tmp_path, path)
+
+def export_model(model, path, dtype=torch.bfloat16):
+    """
+    Writes model for inference only, as a .safetensors file: the weights in dtype (None: as they are), the
+    tied wte/lm_head weight once, no causal mask buffers, and the GPTConfig as JSON in the header; no pickle.
+    load_model(path) maps it back lazily, see load_exported.
+    """
+    tensors = {}
+    for k, v in model.state_dict().items():
+        if k == 'lm_head.weight' or k.endswith('.attn.bias'):
+            continue # tied to wte / rebuilt by build_model
+        tensors[k] = v if dtype is None else v.to(dtype)
+    write_safetensors(path, tensors, {"format": "gpt", "config": json.dumps(asdict(model.config))})
+
+def load_exported(path, device="cpu"):
+    """An eval-mode GPT from a file written by export_model, its weights memory-mapped (read_safetensors)"""
+    tensors, metadata = read_safetensors(path)
+    assert metadata.get("format") == "gpt", f"{path} was not written by export_model"
+    state_dict = dict(tensors)
+    state_dict['lm_head.weight'] = state_dict['transformer.wte.weight']
+    return build_model(GPTConfig(**json.loads(metadata["config"])), state_dict, device)
+
+def find_hf_snapshot(model_type):
+    # the directory of an already downloaded huggingface snapshot of model_type with a model.safetensors, or None
+    hub = os.environ.get("HF_HUB_CACHE") or os.path.join(os.environ.get("HF_HOME", os.path.expanduser("~/.cache/huggingface")), "hub")
+    found = sorted(glob.glob(os.path.join(hub, f"models--{model_type}", "snapshots", "*", "model.safetensors")))
+    return os.path.dirname(found[-1]) if found else None
+
+def load_pretrained(path, device="cpu", cache=True):
+    """
+    An eval-mode GPT from the model.safetensors of a GPT-2 checkpoint (the file, or its directory such as a
+    huggingface snapshot, with the config.json next to it), without transformers: the tensors are memory-mapped
+    (read_safetensors) and adopted by the GPT as is (build_model), so there is only ever one model in memory.
+    The Conv1D weights have to be transposed, which materializes them once; with cache, the result is saved
+    with export_model under PRETRAINED_CACHE_DIR and later loads memory-mapped as a whole.
+    A file written by export_model is loaded as is.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "model.safetensors")
+    # the cached copy is keyed by the file and its version, so a changed or replaced checkpoint is converted again
+    st = os.stat(path)
+    source_key = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+    version_key = hashlib.sha1(f"{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:8]
+    native_path = os.path.join(PRETRAINED_CACHE_DIR, f"model-{source_key}-{version_key}.gpt.safetensors")
+    if cache and os.path.exists(native_path):
+        return load_exported(native_path, device)
+    tensors, metadata = read_safetensors(path)
+    if metadata.get("format") == "gpt":
+        return load_exported(path, device)
+    tensors = {k.removeprefix('transformer.'): v for k, v in tensors.items()}
+    config_file = os.path.join(os.path.dirname(path), "config.json")
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            hf_config = json.load(f)
+        config = GPTConfig(block_size=hf_config['n_positions'], vocab_size=hf_config['vocab_size'],
+                           n_layer=hf_config['n_layer'], n_head=hf_config['n_head'], n_embd=hf_config['n_embd'])
+    else:
+        # no config.json: everything but n_head shows in the shapes, n_head is that of the GPT-2 of that size
+        vocab_size, n_embd = tensors['wte.weight'].shape
+        n_layer = len({k.split('.')[1] for k in tensors if k.startswith('h.')})
+        n_head = next(c['n_head'] for c in GPT2_CONFIGS.values() if (c['n_layer'], c['n_embd']) == (n_layer, n_embd))
+        config = GPTConfig(block_size=tensors['wpe.weight'].size(0), vocab_size=vocab_size, n_layer=n_layer, n_head=n_head, n_embd=n_embd)
+    state_dict = {}
+    for k, v in tensors.items():
+        if k.endswith(('.attn.bias', '.attn.masked_bias')) or k == 'lm_head.weight':
+            continue # the causal masks (buffers, not parameters), and lm_head, which is tied to wte
+        if k.endswith(CONV1D_WEIGHTS):
+            v = v.t().contiguous()
+        state_dict['transformer.' + k] = v
+    state_dict['lm_head.weight'] = state_dict['transformer.wte.weight']
+    model = build_model(config, state_dict)
+    if cache:
+        try:
+            os.makedirs(PRETRAINED_CACHE_DIR, exist_ok=True)
+            export_model(model, native_path, dtype=None)
+            for stale_path in glob.glob(os.path.join(PRETRAINED_CACHE_DIR, f"model-{source_key}-*.gpt.safetensors")):
+                if stale_path != native_path:
+                    os.remove(stale_path) # the copy of an older version of the same file
+        except OSError as e: # e.g. a read-only checkout, the next load just transposes again
+            print(f"could not cache {native_path}: {e}")
+    model.to(device)
+    return model
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    # checkpoints written by `python train_gpt2.py` before the model moved here pickled the config
+    # as __main__.GPTConfig, point that (and train_gpt2.GPTConfig) at the class in this module
+    def find_class(self, module, name):
+        if name == "GPTConfig" and module in ("__main__", "train_gpt2"):
+            return GPTConfig
+        return super().find_class(module, name)
+
+class _checkpoint_pickle:
+    # the pickle_module handed to torch.load, only the Unpickler differs from the stdlib pickle
+    Unpickler = _CheckpointUnpickler
+    load = pickle.load
+    __name__ = "pickle"
+
+def read_checkpoint(path, device="cpu", mmap=False):
+    """The raw dict of a training checkpoint (model and optimizer state, config, step, ...)"""
+    # with mmap, the tensors (on CPU) are backed by a copy-on-write memory map of the file, read as they are used
+    checkpoint = torch.load(path, map_location=device, pickle_module=_checkpoint_pickle, weights_only=False, mmap=mmap)
+    # a torch.compile'd model prefixes its keys with _orig_mod.
+    checkpoint['model'] = {k.removeprefix('_orig_mod.'): v for k, v in checkpoint['model'].items()}
+    return checkpoint
+
+def load_checkpoint(path, device="cpu"):
+    """Builds an eval-mode GPT from a training checkpoint (log/model_XXXXX.pt), returns (model, checkpoint)"""
+    checkpoint = read_checkpoint(path, "cpu", mmap=True)
+    model = build_model(checkpoint['config'], checkpoint['model'], device)
+    return model, checkpoint
+
+def load_model(init_from, device="cpu"):
+    """
+    An eval-mode GPT from a pretrained GPT-2 name (gpt2, gpt2-medium, ...), a model.safetensors file (or its
+    directory), a file written by export_model or a training checkpoint path
+    """
+    if os.path.isdir(init_from) or init_from.endswith(".safetensors"):
+        return load_pretrained(init_from, device)
+    if init_from.startswith("gpt2"):
+        model = GPT.from_pretrained(init_from)
+        model.to(device)
+        model.eval()
+        return model
+    model, _ = load_checkpoint(init_from, device)
+    return model
@@ -0,0 +1,117 @@
+"""
+Perplexity of a GPT on a long text file, e.g. input.txt, which is far longer than the block_size the
+model can attend over. The file is tokenized once, streaming, and scored in overlapping windows of seq_len
+tokens that start stride tokens apart: each window only scores its last tokens, the ones the previous
+window didn't reach, so every token is counted exactly once and (but for the first window) with at least
+seq_len - stride tokens of context. A smaller stride gives more context per token and costs more forwards.
+$ python perplexity.py --init_from log/model_19072.pt --input input.txt
+$ python perplexity.py --init_from gpt2 --input input.txt --stride 512 --device cuda
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+from model import load_model
+
+# -----------------------------------------------------------------------------
+
+def tokenize_file(filename, enc, chunk_chars=1 << 20):
+    """
+    Tokens of a text file, read and encoded about chunk_chars characters at a time, preceded by the
+    <|endoftext|> token like the documents of the training shards. A chunk is only cut between a line
+    ending in a single newline and a line starting with a non-space character: the GPT-2 pre-tokenizer
+    can't merge across such a boundary, so the tokens are the same as encoding the whole file at once.
+    """
+    parts = [np.array([enc._special_tokens['<|endoftext|>']], dtype=np.uint16)]
+    buf = []
+    buf_chars = 0
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            if buf_chars >= chunk_chars and line[:1] and not line[0].isspace():
+                last = buf[-1]
+                if len(last) >= 2 and last[-1] == "\n" and not last[-2].isspace():
+                    parts.append(np.array(enc.encode_ordinary("".join(buf)), dtype=np.uint16))
+                    buf, buf_chars = [], 0
+            buf.append(line)
+            buf_chars += len(line)
+    if buf:
+        parts.append(np.array(enc.encode_ordinary("".join(buf)), dtype=np.uint16))
+    return np.concatenate(parts)
+
+def sliding_windows(num_tokens, seq_len, stride):
+    """
+    (starts, num_scored) of the windows over num_tokens tokens: window i reads tokens
+    [starts[i], starts[i] + seq_len) and scores the predictions of its last num_scored[i] positions.
+    All windows have the same length, so they batch; the last one is aligned to the end of the text.
+    """
+    num_targets = num_tokens - 1 # the first token is never predicted
+    assert seq_len <= num_targets, "the text is shorter than one window"
+    assert 0 < stride <= seq_len
+    starts = list(range(0, num_targets - seq_len + 1, stride))
+    scored_end = [start + seq_len for start in starts] # the targets up to here have been scored
+    if scored_end[-1] < num_targets:
+        starts.append(num_targets - seq_len)
+        scored_end.append(num_targets)
+    starts = np.array(starts, dtype=np.int64)
+    scored_end = np.array(scored_end, dtype=np.int64)
+    num_scored = np.diff(scored_end, prepend=0)
+    return starts, num_scored
+
+@torch.inference_mode()
+def evaluate_perplexity(model, tokens, seq_len, stride, batch_size, device, device_type):
+    """
+    Returns (mean loss in nats per token, number of tokens scored, seconds), running batch_size windows
+    per forward; every token but the first is scored once.
+    """
+    model.eval()
+    tokens = torch.from_numpy(tokens.astype(np.int64))
+    starts, num_scored = sliding_windows(len(tokens), seq_len, stride)
+    offsets = torch.arange(seq_len + 1)
+    positions = torch.arange(seq_len)
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    t0 = time.time()
+    for i in range(0, len(starts), batch_size):
+        start = torch.from_numpy(starts[i:i+batch_size])
+        n = torch.from_numpy(num_scored[i:i+batch_size])
+        buf = tokens[start[:, None] + offsets] # (b, seq_len + 1)
+        x, y = buf[:, :-1].to(device), buf[:, 1:].to(device)
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            _, loss = model(x, y, return_logits=False, reduction="none") # (b, seq_len)
+        scored = (positions[None, :] >= seq_len - n[:, None]).to(device) # the last n positions of each window
+        loss_sum += (loss.double() * scored).sum()
+    num_scored_total = int(num_scored.sum())
+    mean_loss = loss_sum.item() / num_scored_total # .item() waits for the device
+    return mean_loss, num_scored_total, time.time() - t0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--init_from", type=str, default="gpt2", help="gpt2/gpt2-medium/... or a checkpoint path")
+    parser.add_argument("--input", type=str, default="input.txt", help="the text file to score")
+    parser.add_argument("--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--seq_len", type=int, default=None, help="tokens per window, the model's block_size by default")
+    parser.add_argument("--stride", type=int, default=None, help="tokens between window starts, seq_len // 2 by default")
+    parser.add_argument("--batch_size", type=int, default=8, help="windows per forward")
+    args = parser.parse_args()
+
+    import tiktoken
+    enc = tiktoken.get_encoding("gpt2")
+    device_type = "cuda" if args.device.startswith("cuda") else "cpu"
+    torch.set_float32_matmul_precision('high')
+    model = load_model(args.init_from, args.device)
+    seq_len = min(args.seq_len or model.config.block_size, model.config.block_size)
+    stride = args.stride or seq_len // 2
+
+    t0 = time.time()
+    tokens = tokenize_file(args.input, enc)
+    print(f"{args.input}: {len(tokens):,} tokens, tokenized in {time.time() - t0:.1f}s")
+    seq_len = min(seq_len, len(tokens) - 1) # a text shorter than one window is scored in one piece
+    stride = min(stride, seq_len)
+    mean_loss, num_scored, dt = evaluate_perplexity(model, tokens, seq_len, stride, args.batch_size, args.device, device_type)
+    num_windows = len(sliding_windows(len(tokens), seq_len, stride)[0])
+    print(f"windows: {num_windows:,} of {seq_len} tokens, stride {stride}")
+    print(f"loss: {mean_loss:.4f} | perplexity: {np.exp(mean_loss):.2f} | "
+          f"{num_scored / dt:,.0f} tok/sec scored, {num_windows * seq_len / dt:,.0f} tok/sec processed")
+
+if __name__ == "__main__":
+    main()
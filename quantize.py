@@ -0,0 +1,141 @@
+"""
+Int8 weight-only quantization of GPT for CPU inference.
+Every Linear of the transformer (c_attn, c_proj, c_fc) and the lm_head keep their weights as int8
+with one fp32 scale per output channel (symmetric, scale = max|w| / 127); activations stay in
+floating point. lm_head and wte stay tied: the token embedding looks up rows of the same int8
+matrix and scales, since a per-output-channel scale of lm_head is a per-token scale of wte.
+
+Report perplexity drift on input.txt and latency/memory against fp32:
+$ python quantize.py --init_from gpt2
+$ python quantize.py --init_from log/model_19072.pt --eval_tokens 65536
+"""
+
+import time
+import argparse
+import tiktoken
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from model import load_model
+
+# decode-sized matmuls go through torch's int8 weight-only CPU kernel (which wants bf16 activations),
+# larger ones (prefill, eval) are faster as a plain matmul against the weight dequantized on the fly
+INT8_KERNEL_MAX_ROWS = 32
+
+# -----------------------------------------------------------------------------
+
+def quantize_weight(weight):
+    # symmetric per-output-channel int8: returns the (out, in) int8 weight and the (out,) fp32 scales
+    w = weight.detach().float()
+    scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    w_int8 = torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return w_int8, scale
+
+class Int8Linear(nn.Module):
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        weight, scale = quantize_weight(linear.weight)
+        self.register_buffer("weight", weight)
+        self.register_buffer("scale", scale)
+        self.register_buffer("scale_bf16", scale.to(torch.bfloat16)) # the kernel wants scales in the activation dtype
+        self.bias = linear.bias
+
+    def forward(self, x):
+        rows = x.numel() // self.in_features
+        if x.device.type == "cpu" and rows <= INT8_KERNEL_MAX_ROWS and hasattr(torch, "_weight_int8pack_mm"):
+            y = torch._weight_int8pack_mm(x.reshape(rows, self.in_features).to(torch.bfloat16), self.weight, self.scale_bf16)
+            y = y.to(x.dtype).view(*x.shape[:-1], self.out_features)
+        else:
+            y = F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias
+        return y
+
+class Int8Embedding(nn.Module):
+    # token embedding reading the rows of a (tied) Int8Linear's weight, i.e. wte tied to lm_head
+
+    def __init__(self, linear):
+        super().__init__()
+        self.linear = linear
+
+    def forward(self, idx):
+        w = F.embedding(idx, self.linear.weight)
+        return w.float() * self.linear.scale[idx].unsqueeze(-1)
+
+@torch.no_grad()
+def quantize_model(model):
+    """Swaps the Linear layers of a GPT for Int8Linear in place (keeping wte tied to lm_head), returns it"""
+    for block in model.transformer.h:
+        block.attn.c_attn = Int8Linear(block.attn.c_attn)
+        block.attn.c_proj = Int8Linear(block.attn.c_proj)
+        block.mlp.c_fc = Int8Linear(block.mlp.c_fc)
+        block.mlp.c_proj = Int8Linear(block.mlp.c_proj)
+    model.lm_head = Int8Linear(model.lm_head)
+    model.transformer.wte = Int8Embedding(model.lm_head)
+    return model
+
+def weight_bytes(model):
+    # resident bytes of the weights and the buffers inference needs (the int8 scales in both dtypes included),
+    # each shared tensor counted once; the attention mask buffers are not weights
+    seen, total = set(), 0
+    for name, t in list(model.named_parameters()) + list(model.named_buffers()):
+        if name.endswith(".attn.bias") or t.data_ptr() in seen:
+            continue
+        seen.add(t.data_ptr())
+        total += t.numel() * t.element_size()
+    return total
+
+@torch.no_grad()
+def perplexity(model, tokens, block_size, batch_size=8):
+    # mean loss over non-overlapping block_size windows of tokens
+    n = (len(tokens) - 1) // block_size
+    x = tokens[:n*block_size].view(n, block_size)
+    y = tokens[1:n*block_size+1].view(n, block_size)
+    total_loss = 0.0
+    for i in range(0, n, batch_size):
+        _, loss = model(x[i:i+batch_size], y[i:i+batch_size], return_logits=False) # the loss-only path, as evaluate_loss uses it
+        total_loss += loss.item() * x[i:i+batch_size].size(0)
+    return torch.exp(torch.tensor(total_loss / n)).item()
+
+@torch.no_grad()
+def latency(model, prompt, max_new_tokens, repeats=3):
+    # (prefill ms, decode tokens/sec), best of a few runs
+    model(prompt) # warmup
+    prefill, decode = float("inf"), 0.0
+    for _ in range(repeats):
+        t0 = time.time()
+        model(prompt, last_only=True)
+        prefill = min(prefill, time.time() - t0)
+        t0 = time.time()
+        model.generate(prompt, max_new_tokens, top_k=50)
+        decode = max(decode, max_new_tokens / (time.time() - t0))
+    return prefill * 1000, decode
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--init_from", type=str, default="gpt2", help="gpt2/gpt2-medium/... or a checkpoint path")
+    parser.add_argument("--input", type=str, default="input.txt", help="text file to measure perplexity on")
+    parser.add_argument("--eval_tokens", type=int, default=32768, help="tokens of the file to evaluate")
+    parser.add_argument("--block_size", type=int, default=1024)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    enc = tiktoken.get_encoding("gpt2")
+    with open(args.input, "r") as f:
+        tokens = torch.tensor(enc.encode(f.read())[:args.eval_tokens + 1], dtype=torch.long)
+    prompt = torch.tensor([enc.encode("Hello, I'm a language model,")], dtype=torch.long)
+    block_size = min(args.block_size, (len(tokens) - 1))
+
+    model = load_model(args.init_from, "cpu")
+    results = {}
+    for name in ("fp32", "int8"):
+        if name == "int8":
+            quantize_model(model)
+        ppl = perplexity(model, tokens, block_size)
+        prefill_ms, decode_tps = latency(model, prompt, args.max_new_tokens)
+        results[name] = (ppl, prefill_ms, decode_tps, weight_bytes(model))
+        print(f"{name}: ppl {ppl:.3f} | prefill {prefill_ms:.1f}ms | decode {decode_tps:.1f} tok/sec | weights {results[name][3] / 2**20:.1f} MiB")
+    (ppl32, pre32, dec32, mem32), (ppl8, pre8, dec8, mem8) = results["fp32"], results["int8"]
+    print(f"perplexity drift: {100 * (ppl8 - ppl32) / ppl32:+.2f}% | prefill {pre32 / pre8:.2f}x | decode {dec8 / dec32:.2f}x | weights {mem32 / mem8:.2f}x smaller")
@@ -0,0 +1,334 @@
+"""
+Local inference server for GPT checkpoints, with continuous batching.
+Requests join the running batch as soon as a slot is free and leave it as soon as they finish,
+so every decode step forwards one token for each running request against a shared KV cache.
+Runs on CPU (or any device torch supports).
+
+Serve a checkpoint written by train_gpt2.py (or a pretrained GPT-2):
+$ python serve.py --init_from log/model_19072.pt --port 8000
+$ curl -s localhost:8000/generate -d '{"prompt": "Hello, I am a language model,", "max_length": 32, "top_k": 50, "temperature": 1.0}'
+$ curl -s localhost:8000/stats
+Load test in-process, without HTTP:
+$ python serve.py --init_from gpt2 --bench 64
+"""
+
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+import traceback
+import collections
+import numpy as np
+import tiktoken
+import torch
+from model import KVCache, load_model, sample
+
+enc = tiktoken.get_encoding("gpt2")
+
+# -----------------------------------------------------------------------------
+
+class SlotKVCache:
+    """
+    KV cache for continuous batching: one slot per running request, each with its own length.
+    The running requests always occupy slots 0..n_active-1, so a decode step works on plain views
+    of the buffers; when a request leaves, the last slot is moved into its place.
+    Implements the same positions/attention_args/update/advance interface as model.KVCache,
+    for decode steps of one token per running request.
+    """
+
+    def __init__(self, config, max_batch, max_len, device, dtype=torch.float32):
+        hs = config.n_embd // config.n_head
+        shape = (config.n_layer, max_batch, config.n_head, max_len, hs)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.max_len = max_len
+        self.lengths = torch.zeros(max_batch, dtype=torch.long, device=device) # cached positions per slot
+        self.lens = [] # the same for the active slots, as python ints
+        self.rows = torch.arange(max_batch, device=device)
+
+    @property
+    def n_active(self):
+        return len(self.lens)
+
+    @property
+    def pos(self):
+        # the longest running sequence, which is what GPT.forward checks against block_size
+        return max(self.lens, default=0)
+
+    def positions(self, T, device):
+        assert T == 1, "SlotKVCache only decodes one token per request per step"
+        return self.lengths[:self.n_active].unsqueeze(1) # (B, 1), each row at its own position
+
+    def attention_args(self, T):
+        # each row only sees its own cached positions plus the new token
+        L = self.pos + 1
+        mask = torch.arange(L, device=self.k.device)[None, :] < (self.lengths[:self.n_active] + 1)[:, None]
+        return mask.view(self.n_active, 1, 1, L), False
+
+    def update(self, layer, k, v):
+        n = self.n_active
+        rows, cols = self.rows[:n], self.lengths[:n]
+        self.k[layer, rows, :, cols] = k[:, :, 0]
+        self.v[layer, rows, :, cols] = v[:, :, 0]
+        L = self.pos + 1
+        return self.k[layer, :n, :, :L], self.v[layer, :n, :, :L]
+
+    def advance(self, T):
+        self.lengths[:self.n_active] += T
+        self.lens = [l + T for l in self.lens]
+
+    def insert(self, kv_cache):
+        # copy a prefilled single-sequence KVCache into the next free slot, returns the slot
+        slot, T = self.n_active, kv_cache.pos
+        assert slot < self.k.size(1), "no free slot"
+        self.k[:, slot, :, :T] = kv_cache.k[:, 0, :, :T]
+        self.v[:, slot, :, :T] = kv_cache.v[:, 0, :, :T]
+        self.lengths[slot] = T
+        self.lens.append(T)
+        return slot
+
+    def remove(self, slot):
+        # drop a slot by moving the last active slot into it
+        last = self.n_active - 1
+        if slot != last:
+            T = self.lens[last]
+            self.k[:, slot, :, :T] = self.k[:, last, :, :T]
+            self.v[:, slot, :, :T] = self.v[:, last, :, :T]
+            self.lengths[slot] = T
+            self.lens[slot] = T
+        self.lens.pop()
+
+class Request:
+    def __init__(self, tokens, max_length, temperature=1.0, top_k=50, on_done=None):
+        self.tokens = list(tokens)
+        self.prompt_len = len(self.tokens)
+        self.max_length = max_length # total length, prompt included, as in the training script's sampler
+        self.temperature = temperature
+        self.top_k = top_k
+        self.on_done = on_done # called with the request once it finished, from the engine thread
+        self.error = None # the exception that failed the request, if any
+        self.t_submit = time.time()
+        self.token_times = [] # wall time at which each new token was produced
+
+    @property
+    def done(self):
+        return len(self.tokens) >= self.max_length or self.tokens[-1] == enc.eot_token
+
+    def latencies(self):
+        # per-token latency: time to first token, then the gap between consecutive tokens
+        times = [self.t_submit] + self.token_times
+        return [b - a for a, b in zip(times[:-1], times[1:])]
+
+class Engine:
+    """
+    Continuous batching loop. New requests are prefilled one at a time (one forward over the prompt
+    into a single-sequence KVCache) and copied into a free slot of the shared SlotKVCache; then every
+    step forwards the last token of all running requests at once and retires the finished ones.
+    A step that raises (out of memory, bad sampling arguments, ...) fails the requests it was working on
+    and leaves the engine running with an empty batch.
+    """
+
+    def __init__(self, model, max_batch=8, max_len=None, seed=42):
+        self.model = model
+        self.config = model.config
+        self.device = next(model.parameters()).device
+        self.max_batch = max_batch
+        self.max_len = min(max_len or self.config.block_size, self.config.block_size)
+        self.dtype = next(model.parameters()).dtype
+        self.cache = SlotKVCache(self.config, max_batch, self.max_len, self.device, self.dtype)
+        self.pending = queue.Queue()
+        self.active = [] # running requests, self.active[i] lives in cache slot i
+        self.prefilling = None # the request being prefilled, not in self.active yet
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+        # stats since the engine started, updated on the engine thread and read from the asyncio one
+        self.stats_lock = threading.Lock()
+        self.t_start = time.time()
+        self.num_tokens = 0
+        self.latencies = collections.deque(maxlen=100000) # per-token latencies of the most recent requests
+
+    def submit(self, request):
+        if not (0 < request.prompt_len < request.max_length <= self.max_len):
+            raise ValueError(f"need 0 < prompt length ({request.prompt_len}) < max_length ({request.max_length}) <= {self.max_len}")
+        self.pending.put(request)
+
+    def _emit(self, requests, next_tokens):
+        now = time.time()
+        for request, token in zip(requests, next_tokens.view(-1).tolist()):
+            request.tokens.append(token)
+            request.token_times.append(now)
+        with self.stats_lock:
+            self.num_tokens += len(requests)
+
+    def _finish(self, request):
+        if request.error is None:
+            with self.stats_lock:
+                self.latencies.extend(request.latencies())
+        if request.on_done is not None:
+            request.on_done(request)
+
+    def _sampling_args(self, requests):
+        temperature = torch.tensor([r.temperature for r in requests], dtype=torch.float32, device=self.device)
+        top_k = torch.tensor([r.top_k or 0 for r in requests], dtype=torch.long, device=self.device)
+        return temperature, top_k
+
+    @torch.no_grad()
+    def _prefill(self, request):
+        idx = torch.tensor([request.tokens], dtype=torch.long, device=self.device)
+        kv_cache = KVCache(self.config, 1, max_len=request.prompt_len)
+        logits, _ = self.model(idx, kv_cache=kv_cache, last_only=True)
+        self._emit([request], sample(logits[:, -1, :], *self._sampling_args([request]), generator=self.generator))
+        if request.done:
+            self._finish(request)
+        else:
+            self.cache.insert(kv_cache)
+            self.active.append(request)
+
+    @torch.no_grad()
+    def step(self):
+        # admit new requests into the free slots
+        while len(self.active) < self.max_batch:
+            try:
+                request = self.pending.get(block=not self.active) # idle: wait for work
+            except queue.Empty:
+                break
+            self.prefilling = request
+            self._prefill(request)
+            self.prefilling = None
+        if not self.active:
+            return
+        # one decode step for every running request
+        idx = torch.tensor([[r.tokens[-1]] for r in self.active], dtype=torch.long, device=self.device)
+        logits, _ = self.model(idx, kv_cache=self.cache, last_only=True)
+        self._emit(self.active, sample(logits[:, -1, :], *self._sampling_args(self.active), generator=self.generator))
+        # retire finished requests, back to front so the slot swaps do not disturb the ones still to check
+        for i in reversed(range(len(self.active))):
+            if self.active[i].done:
+                request = self.active[i]
+                self.cache.remove(i)
+                self.active[i] = self.active[-1]
+                self.active.pop()
+                self._finish(request)
+
+    def _fail(self, error):
+        # fail every request the step was working on and start over from an empty batch
+        failed = self.active + ([self.prefilling] if self.prefilling is not None else [])
+        self.active, self.prefilling = [], None
+        self.cache = SlotKVCache(self.config, self.max_batch, self.max_len, self.device, self.dtype) # may be half updated
+        for request in failed:
+            request.error = error
+            self._finish(request)
+
+    def run_forever(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                traceback.print_exc()
+                self._fail(e)
+
+    def stats(self):
+        with self.stats_lock:
+            num_tokens = self.num_tokens
+            lat = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "tokens": num_tokens,
+            "tokens_per_sec": num_tokens / (time.time() - self.t_start),
+            "running": len(self.active),
+            "pending": self.pending.qsize(),
+            "latency_ms_p50": float(np.percentile(lat, 50)),
+            "latency_ms_p99": float(np.percentile(lat, 99)),
+        }
+
+# -----------------------------------------------------------------------------
+# asyncio front end
+
+async def generate(engine, prompt, max_length=32, temperature=1.0, top_k=50):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def on_done(r):
+        if r.error is not None:
+            loop.call_soon_threadsafe(future.set_exception, r.error)
+        else:
+            loop.call_soon_threadsafe(future.set_result, r)
+    request = Request(enc.encode(prompt), max_length, temperature, top_k, on_done=on_done)
+    engine.submit(request)
+    request = await future
+    latencies = request.latencies()
+    return {
+        "text": enc.decode(request.tokens),
+        "completion": enc.decode(request.tokens[request.prompt_len:]),
+        "num_tokens": len(request.tokens) - request.prompt_len,
+        "time_to_first_token": latencies[0],
+        "seconds": request.token_times[-1] - request.t_submit,
+    }
+
+async def handle_http(engine, reader, writer):
+    # a deliberately tiny HTTP/1.1 handler: POST /generate with a JSON body, GET /stats
+    try:
+        request_line = (await reader.readline()).decode().split()
+        headers = {}
+        while (line := (await reader.readline()).decode().strip()):
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        method, path = request_line[0], request_line[1]
+        if method == "POST" and path == "/generate":
+            args = json.loads(body or b"{}")
+            status, payload = 200, await generate(engine, args["prompt"], int(args.get("max_length", 32)),
+                                                  float(args.get("temperature", 1.0)), int(args.get("top_k", 50)))
+        elif method == "GET" and path == "/stats":
+            status, payload = 200, engine.stats()
+        else:
+            status, payload = 404, {"error": f"unknown route {method} {path}"}
+    except (ValueError, KeyError, IndexError) as e:
+        status, payload = 400, {"error": str(e)}
+    except Exception as e:
+        status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+    data = json.dumps(payload).encode()
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+    await writer.drain()
+    writer.close()
+
+async def serve(engine, host, port):
+    server = await asyncio.start_server(lambda r, w: handle_http(engine, r, w), host, port)
+    print(f"serving on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+async def bench(engine, num_requests, max_length):
+    # fire all requests at once and let the engine batch them
+    prompts = ["Hello, I'm a language model,", "The meaning of life is", "Once upon a time,", "In machine learning,"]
+    t0 = time.time()
+    results = await asyncio.gather(*[generate(engine, prompts[i % len(prompts)], max_length) for i in range(num_requests)])
+    dt = time.time() - t0
+    num_tokens = sum(r["num_tokens"] for r in results)
+    ttft = np.array([r["time_to_first_token"] for r in results]) * 1000
+    stats = engine.stats()
+    print(f"{num_requests} requests | {num_tokens} tokens in {dt:.2f}s | {num_tokens / dt:.1f} tok/sec")
+    print(f"per-token latency p50 {stats['latency_ms_p50']:.1f}ms p99 {stats['latency_ms_p99']:.1f}ms | "
+          f"time to first token p50 {np.percentile(ttft, 50):.1f}ms p99 {np.percentile(ttft, 99):.1f}ms")
+    print(f"sample: {results[0]['text']!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--init_from", type=str, required=True, help="a log/model_XXXXX.pt checkpoint, or gpt2/gpt2-medium/...")
+    parser.add_argument("--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=8, help="maximum number of requests decoded together")
+    parser.add_argument("--max_len", type=int, default=None, help="maximum total tokens per request (default: block_size)")
+    parser.add_argument("--bench", type=int, default=0, help="run this many concurrent in-process requests and report, instead of serving")
+    parser.add_argument("--bench_length", type=int, default=64, help="max_length of the benchmark requests")
+    args = parser.parse_args()
+
+    model = load_model(args.init_from, args.device)
+    engine = Engine(model, max_batch=args.max_batch, max_len=args.max_len)
+    threading.Thread(target=engine.run_forever, daemon=True).start()
+    if args.bench:
+        asyncio.run(bench(engine, args.bench, args.bench_length))
+    else:
+        asyncio.run(serve(engine, args.host, args.port))
@@ -0,0 +1,140 @@
+"""
+Speculative sampling (https://arxiv.org/abs/2302.01318) with a small draft GPT.
+The draft model proposes k tokens one at a time, the target model scores all of them in a single
+forward, and each proposal is kept with probability min(1, p/q) (p: target, q: draft). At the first
+rejection a token is drawn from the normalized max(0, p - q) instead; if all k are kept, one more
+token comes for free from the target's last distribution. The output is distributed exactly as
+sampling from the target alone, but the target runs once per accepted run of tokens.
+
+Benchmark acceptance rate and speedup over plain (KV-cached) target sampling:
+$ python speculative.py --target gpt2 --draft log_small/model_19072.pt --k 4 --max_new_tokens 128
+Any pair of models sharing the GPT-2 tokenizer works, e.g. --target gpt2-medium --draft gpt2.
+"""
+
+import time
+import argparse
+import tiktoken
+import torch
+from torch.nn import functional as F
+from model import KVCache, load_model
+
+# -----------------------------------------------------------------------------
+
+def get_probs(logits, vocab_size, temperature=1.0, top_k=None):
+    # next-token distribution over the first vocab_size tokens (the two models may pad their vocab
+    # differently), after temperature and top-k; temperature 0 is greedy, i.e. one-hot on the argmax
+    logits = logits[..., :vocab_size].float()
+    if temperature == 0:
+        return F.one_hot(logits.argmax(dim=-1), vocab_size).float()
+    logits = logits / temperature
+    if top_k is not None:
+        kth = torch.topk(logits, min(top_k, vocab_size), dim=-1).values[..., [-1]]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    return F.softmax(logits, dim=-1)
+
+@torch.no_grad()
+def speculative_generate(target, draft, idx, max_new_tokens, k=4, temperature=1.0, top_k=50, generator=None):
+    """
+    Samples max_new_tokens tokens after the (1, T) prompt idx from the target model, with the draft
+    model proposing k tokens per target forward. Returns the (1, T+max_new_tokens) sequence and a
+    dict of stats (target forwards, proposed and accepted draft tokens).
+    """
+    assert idx.size(0) == 1, "speculative_generate decodes one sequence at a time"
+    device = idx.device
+    vocab_size = min(target.config.vocab_size, draft.config.vocab_size)
+    T = idx.size(1)
+    max_len = T + max_new_tokens + k
+    assert max_len <= min(target.config.block_size, draft.config.block_size), "sequence too long for the block size"
+    target_cache = KVCache(target.config, 1, max_len=max_len)
+    draft_cache = KVCache(draft.config, 1, max_len=max_len)
+    tokens = idx[0].tolist()
+    stats = {"target_forwards": 0, "proposed": 0, "accepted": 0}
+    rand = lambda: torch.rand(1, generator=generator, device=device).item()
+    sample = lambda p: torch.multinomial(p, 1, generator=generator).item()
+
+    while len(tokens) < T + max_new_tokens:
+        # never propose past the requested length: the last round may need fewer drafts
+        n_draft = min(k, T + max_new_tokens - len(tokens) - 1)
+        n = len(tokens)
+
+        # 1) the draft proposes n_draft tokens, feeding first whatever it has not cached yet
+        drafts, q = [], []
+        feed = tokens[draft_cache.pos:]
+        for _ in range(n_draft):
+            logits, _ = draft(torch.tensor([feed], device=device), kv_cache=draft_cache, last_only=True)
+            q.append(get_probs(logits[0, -1], vocab_size, temperature, top_k))
+            drafts.append(sample(q[-1]))
+            feed = [drafts[-1]]
+
+        # 2) the target scores the uncached tokens plus all proposals in one forward
+        feed = tokens[target_cache.pos:] + drafts
+        logits, _ = target(torch.tensor([feed], device=device), kv_cache=target_cache)
+        p = get_probs(logits[0, -(n_draft+1):], vocab_size, temperature, top_k) # (n_draft+1, vocab)
+        stats["target_forwards"] += 1
+        stats["proposed"] += n_draft
+
+        # 3) accept each proposal with probability min(1, p/q), stop at the first rejection
+        accepted = 0
+        for i, d in enumerate(drafts):
+            if rand() < min(1.0, (p[i, d] / q[i][d]).item()):
+                accepted += 1
+                continue
+            # rejected: resample from the part of p that q does not already cover
+            residual = torch.clamp(p[i] - q[i], min=0)
+            next_token = sample(residual if residual.sum() > 0 else p[i])
+            break
+        else:
+            # every proposal accepted: the target's distribution after the last one is a free extra token
+            next_token = sample(p[n_draft])
+        stats["accepted"] += accepted
+        tokens.extend(drafts[:accepted] + [next_token])
+
+        # 4) roll both caches back to the tokens that were kept; next_token itself is not cached yet
+        target_cache.pos = n + accepted
+        draft_cache.pos = min(draft_cache.pos, n + accepted)
+
+    return torch.tensor([tokens[:T + max_new_tokens]], device=device), stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, default="gpt2", help="target model: gpt2/gpt2-medium/... or a checkpoint path")
+    parser.add_argument("--draft", type=str, required=True, help="draft model: a (small) checkpoint path or gpt2/...")
+    parser.add_argument("--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--k", type=int, default=4, help="draft tokens proposed per target forward")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--num_samples", type=int, default=5, help="samples per method, timings are summed")
+    parser.add_argument("--prompt", type=str, default="Hello, I'm a language model,")
+    args = parser.parse_args()
+
+    enc = tiktoken.get_encoding("gpt2")
+    target = load_model(args.target, args.device)
+    draft = load_model(args.draft, args.device)
+    idx = torch.tensor([enc.encode(args.prompt)], dtype=torch.long, device=args.device)
+    generator = torch.Generator(device=args.device)
+    generator.manual_seed(42)
+
+    # baseline: the target alone, with its KV cache (temperature 0 is greedy, i.e. top-1)
+    temperature, top_k = (args.temperature, args.top_k) if args.temperature > 0 else (1.0, 1)
+    target.generate(idx, 8, temperature=temperature, top_k=top_k, generator=generator) # warmup
+    t0 = time.time()
+    for _ in range(args.num_samples):
+        out = target.generate(idx, args.max_new_tokens, temperature=temperature, top_k=top_k, generator=generator)
+    baseline_dt = time.time() - t0
+
+    totals = {"target_forwards": 0, "proposed": 0, "accepted": 0}
+    t0 = time.time()
+    for _ in range(args.num_samples):
+        out, stats = speculative_generate(target, draft, idx, args.max_new_tokens, k=args.k,
+                                          temperature=args.temperature, top_k=args.top_k, generator=generator)
+        for key in totals:
+            totals[key] += stats[key]
+    spec_dt = time.time() - t0
+
+    num_tokens = args.num_samples * args.max_new_tokens
+    print(f"sample: {enc.decode(out[0].tolist())!r}")
+    print(f"acceptance rate: {totals['accepted'] / max(totals['proposed'], 1):.3f} | "
+          f"tokens per target forward: {num_tokens / totals['target_forwards']:.2f}")
+    print(f"baseline: {num_tokens / baseline_dt:.1f} tok/sec | speculative (k={args.k}): {num_tokens / spec_dt:.1f} tok/sec | "
+          f"speedup: {baseline_dt / spec_dt:.2f}x")
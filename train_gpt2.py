@@ -1,607 +1,387 @@
+import os
+import gc
 import math
-from dataclasses import dataclass
+import time
+import argparse
+import tiktoken
 import torch
-import torch.nn as nn
-from torch.nn import functional as F
-import inspect
-from hellaswag import render_example, iterate_examples
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed import init_process_group, destroy_process_group
+from zero import ShardedGradients
+from model import GPT, GPTConfig, read_checkpoint
+from eval_gpt2 import evaluate_loss, evaluate_hellaswag
+from data import DataLoaderLite, ShuffledDataLoader, PrefetchLoader, ValidationSet
+from metrics import StepTimer, MetricsLogger, ProfilerHook, estimate_mfu, peak_memory, compile_stats, format_compile_stats, truncate_log
+from checkpoint import AsyncCheckpointer, snapshot, rng_state, set_rng_state, latest_checkpoint
 
 # torchrun --standalone --nproc_per_node=8 train_gpt2.py
+# without GPUs, the same launch trains on CPU with gloo, each rank pinned to its own share of the cores
 # torchrun --standalone --nproc_per_node=8 train_gpt2.py --write_tensors=0 --num_iterations=50 --sequence_length=1024 --compile=1 --tensorcores=1 --dtype=bfloat16
 
-### 아래와 같은 약 100줄의 코드로 기존에 약 2천줄에 달하는 코드를 간소화시켰다
-# https://github.com/huggingface/transformers/blob/main/src/transformers/models/gpt2/modeling_gpt2.py
-class CausalSelfAttention(nn.Module): ### Andrej Karpathy의 다른 강의에서 보였던 Head를 Multi-Head Attention으로 구현한 것을, pytorch에서의 연산 효율성을 위해 하나의 모듈로 재구성한 것일 뿐임. 본질적으로 같다.
-
-    def __init__(self, config):
-        super().__init__()
-        assert config.n_embd % config.n_head == 0
-        # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
-        # output projection
-        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1
-        # regularization
-        self.n_head = config.n_head
-        self.n_embd = config.n_embd
-        # not really a 'bias', more of a mask, but following the OpenAI/HF naming though
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
-                             .view(1, 1, config.block_size, config.block_size))
-
-    def forward(self, x):
-        B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
-        # calculate query, key, values for all heads in batch and move head forward to be the batch
-        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
-        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the transformer
-        qkv = self.c_attn(x)
-        q, k, v =qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True) ### 최적화 #4
-        # attention (materializes the large (T,T) matrix for all the queries and keys)
-        
-        # att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) ### q,k간에 상호 얼마나 참조하는지 파악
-        # att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf')) ### autoregressive mask를 적용하여, 과거의 데이터만 보게 만들고,
-        # att = F.softmax(att, dim=-1) ### SoftMax로 1로 normalize시키고
-        # y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs) ### Weighted Sum 을 계산하고,
-
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side ##Concatenation 연산에 해당
-        # output projection
-        y = self.c_proj(y)
-        return y
-
-class MLP(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.c_fc   = nn.Linear(config.n_embd, 4 * config.n_embd)
-        self.gelu   = nn.GELU(approximate='tanh') ### 초창기 tensorflow에서 erf속도가 너무 느려서 tanh로 GELU를 approximation하는 것을 만들었음. 지금은 gelu자체에 속도 이슈가 없어서 approximation을 사용할 이유가 없으나, 최대한 GPT-2에 근접하게 만드는 것이 오늘 강의의 목표이므로, approximation을 사용했음. ### 그리고, relu대신 gelu를 사용하면 0 근처에서의 학습 데이터를 계속해서 사용할 수 있는 강점이 있기 때문. 최근에는 gelu 이후 다른 함수들을 많이 쓰고 있지만, 같은 이유로 오늘은 gelu를 사용한다.
-        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1
-
-
-    def forward(self, x):
-        x = self.c_fc(x)
-        x = self.gelu(x)
-        x = self.c_proj(x)
-        return x
-
-class Block(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.ln_1 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config)
-        self.ln_2 = nn.LayerNorm(config.n_embd)
-        self.mlp = MLP(config)
-
-    def forward(self, x): # Residual한 Path를 깔끔하게 내려주는 것이 0.기본문서보다 더 동작을 잘 하게 만들 수 있다.
-        x = x + self.attn(self.ln_1(x)) ## 어텐션은 커뮤니케이션 연산에 해당. 1024개 토큰끼리 상호 작용이 활발하게 일어나기 때문에, aggregation,pooling,weighted sum,reduce라고 볼 수 있고,
-        x = x + self.mlp(self.ln_2(x)) ## MLP는 모든 토큰이 개별적으로 연산되고, 토큰 간의 연산은 없음. 따라서, 윗 줄의 attn은 REDUCE, 이 줄의 mlp는 MAP에 해당한다고도 볼 수 있다. 즉, Transformer는 Map Reduce의 반복이라고도 볼 수 있음.
-        return x
-
-@dataclass
-class GPTConfig: ### huggingface에 올라온 gpt2 124M모델과 hyperparameter를 맞췄음.
-    block_size: int = 1024 # max sequence length
-    vocab_size: int = 50257 # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|>
-    n_layer: int = 12 # number of layers
-    n_head: int = 12 # number of heads
-    n_embd: int = 768 # embedding dimension
-
-class GPT(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.config = config
-
-        self.transformer = nn.ModuleDict(dict(
-            wte = nn.Embedding(config.vocab_size, config.n_embd), # Figure 1.에서는 Output Embedding이라고 적혀있지만, 그것이 여기서는 Token Embedding (wte)에 해당
-            wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]), 
-            ln_f = nn.LayerNorm(config.n_embd), #Layer normalization 은 각 블록의 뒤로 옮겨졌다. #Layer normalization (Ba et al., 2016) was moved to the input of each sub-block, similar to a pre-activation residual network
-        ))
-        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False) #an additional layer normalization was added after the final self attention block.
-
-        ## weight sharing scheme
-        self.transformer.wte.weight = self.lm_head.weight
-
-        # init params
-        self.apply(self._init_weights)
-
-    def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            std = 0.02
-            if hasattr(module, 'NANOGPT_SCALE_INIT'):
-                std *= (2 * self.config.n_layer) ** -0.5 ##
-            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
-            if module.bias is not None:
-                torch.nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
-
-    def forward(self, idx, targets=None): ## 인풋은 항상 인덱스인데, 'token'의 인덱스들임. BxT사이즈
-        # idx is of shape (B, T) ## T는 타임, T개의 token이 존재함. idx는 항상 BxT이다!
-        B, T = idx.size()
-        assert T <= self.config.block_size, f"Cannot forward sequence of length {T}, block size is only {self.config.block_size}"
-        # forward the token and position embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (T, n_embd)
-        tok_emb = self.transformer.wte(idx) # token embeddings of shape (B, T, n_embd)
-        x = tok_emb + pos_emb
-        # forward the blocks of the transformer
-        for block in self.transformer.h:
-            x = block(x)
-        # forward the final layernorm and the classifier
-        x = self.transformer.ln_f(x)
-        logits = self.lm_head(x) # (B, T, vocab_size)
-        loss = None
-        if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1)) ## Cross_Entropy는 2차원을 인풋으로 받지 못하기 때문에 BxT를 flatten시키는 작업이 필요했다. (B*T, voab_size)
-        return logits, loss
-
-    @classmethod
-    def from_pretrained(cls, model_type):
-        """Loads pretrained GPT-2 model weights from huggingface"""
-        assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
-        from transformers import GPT2LMHeadModel
-        print("loading weights from pretrained gpt: %s" % model_type)
-
-        # n_layer, n_head and n_embd are determined from model_type
-        config_args = {
-            'gpt2':         dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
-            'gpt2-medium':  dict(n_layer=24, n_head=16, n_embd=1024), # 350M params
-            'gpt2-large':   dict(n_layer=36, n_head=20, n_embd=1280), # 774M params
-            'gpt2-xl':      dict(n_layer=48, n_head=25, n_embd=1600), # 1558M params
-        }[model_type]
-        config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
-        config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
-        # create a from-scratch initialized minGPT model
-        config = GPTConfig(**config_args)
-        model = GPT(config)
-        sd = model.state_dict()
-        sd_keys = sd.keys()
-        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
-
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
-
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
-        sd_keys_hf = sd_hf.keys()
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
-        transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
-        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
-        # this means that we have to transpose these weights when we import them
-        assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
-        for k in sd_keys_hf:
-            if any(k.endswith(w) for w in transposed):
-                # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
-            else:
-                # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
-
-        return model
-    
-    def configure_optimizers(self, weight_decay, learning_rate, device):
-        # start with all of the candidate parameters (that require grad)
-        param_dict = {pn: p for pn, p in self.named_parameters()}
-        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
-        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no. 
-        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
-        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2]
-        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2]
-        optim_groups = [
-            {'params': decay_params, 'weight_decay': weight_decay},
-            {'params': nodecay_params, 'weight_decay': 0.0}
-        ]
-        num_decay_params = sum(p.numel() for p in decay_params)
-        num_nodecay_params = sum(p.numel() for p in nodecay_params)
-        print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
-        print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
-        # Create AdamW optimizer and use the fused version if it is available
-        fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
-        use_fused = fused_available and 'cuda' in device
-        print(f"using fused AdamW: {use_fused}")
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
-        return optimizer
-
-#####-----------
-import tiktoken
-enc = tiktoken.get_encoding("gpt2")
-
-import numpy as np
-
-def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32) # added after video
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
-
-class DataLoaderLite:
-    def __init__(self, B, T, process_rank, num_processes, split):
-        self.B = B
-        self.T = T
-        self.process_rank = process_rank
-        self.num_processes = num_processes
-        assert split in {'train', 'val'}
-
-        # with open('input.txt', 'r') as f:
-        #     text = f.read()
-        # enc = tiktoken.get_encoding('gpt2') # GPT-2 토크나이저 사용
-        # tokens = enc.encode(text)
-        # self.tokens = torch.tensor(tokens)
-        # print(f"loaded {len(self.tokens)} tokens")
-        # print(f"1 epoch = {len(self.tokens) // (B * T)} batches")
-        
-        data_root = "edu_fineweb10B"
-        shards = os.listdir(data_root)
-        shards = [s for s in shards if split in s]
-        shards = sorted(shards)
-        shards = [os.path.join(data_root, s) for s in shards]
-        self.shards = shards
-        assert len(shards) > 0, f"no shards found for split {split}"
-        if master_process:
-            print(f"found {len(shards)} shards for split {split}")
-        self.reset()
-
-        # self.current_shard = 0
-        # self.tokens = load_tokens(self.shards[self.current_shard])
-               
-        # # state
-        # # self.current_position = 0
-        # self.current_position = self.B * self.T * self.process_rank
-    def reset(self):
-        # state, init at shard zero
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = self.B * self.T * self.process_rank
-
-    def next_batch(self):
-        B, T = self.B, self.T
-        buf = self.tokens[self.current_position : self.current_position+B*T+1]
-        x = (buf[:-1]).view(B, T) # inputs
-        y = (buf[1:]).view(B, T) # targets
-        # advance the position in the tensor
-        # self.current_position += B * T
-        self.current_position += B * T * self.num_processes
-        # if loading the next batch would be out of bounds, reset
-        # if self.current_position + (B * T + 1) > len(self.tokens):
-        #     self.current_position = 0 # 데이터를 다 사용했으면, 다시 0으로 돌아와서 다음 에폭을 시작하자.
-        if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
-            self.current_shard = (self.current_shard + 1) % len(self.shards)
-            self.tokens = load_tokens(self.shards[self.current_shard])
-            self.current_position = self.B * self.T * self.process_rank # 데이터를 다 사용했으면, 다시 0으로 돌아와서 다음 에폭을 시작하자.
-        return x, y
-
 # -----------------------------------------------------------------------------
-# helper function for HellaSwag eval
-# takes tokens, mask, and logits, returns the index of the completion with the lowest loss
-
-def get_most_likely_row(tokens, mask, logits):
-    # evaluate the autoregressive loss at all positions
-    shift_logits = (logits[..., :-1, :]).contiguous()
-    shift_tokens = (tokens[..., 1:]).contiguous()
-    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-    flat_shift_tokens = shift_tokens.view(-1)
-    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-    shift_losses = shift_losses.view(tokens.size(0), -1)
-    # now get the average loss just for the completion region (where mask == 1), in each row
-    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-    masked_shift_losses = shift_losses * shift_mask
-    # sum and divide by the number of 1s in the mask
-    sum_loss = masked_shift_losses.sum(dim=1)
-    avg_loss = sum_loss / shift_mask.sum(dim=1)
-    # now we have a loss for each of the 4 completions
-    # the one with the lowest loss should be the most likely
-    pred_norm = avg_loss.argmin().item()
-    return pred_norm
-
-#------------------
-# attempt to autodetect the decvice
-import time
-import os
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
-# from torch.distributed.optim import ZeroRedundancyOptimizer
-import torch.distributed as dist
 
-ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
-if ddp:
-    # use of DDP atm demands CUDA, we set the device appropriately according to rank
-    assert torch.cuda.is_available(), "for now i think we need CUDA for DDP"
-    init_process_group(backend='nccl')
-    ddp_rank = int(os.environ['RANK'])
-    ddp_local_rank = int(os.environ['LOCAL_RANK'])
-    ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
-    master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
-else:
-    # vanilla, non-DDP run
-    ddp_rank = 0
-    ddp_local_rank = 0
-    ddp_world_size = 1
-    master_process = True
-    # attempt to autodetect device
-    device = "cpu"
+def pin_cpu_threads(local_rank, local_world_size):
+    # give each process on this node its own contiguous block of cores and one intra-op thread per core:
+    # left alone, every rank would start a thread per core (or just one, torchrun sets OMP_NUM_THREADS=1)
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    per_rank = max(1, len(cores) // local_world_size)
+    start = (local_rank * per_rank) % len(cores) # more ranks than cores: they share
+    cores = cores[start:start + per_rank]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    return cores
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="continue from the latest checkpoint in the log directory")
+    args = parser.parse_args()
+
+    enc = tiktoken.get_encoding("gpt2")
+
+    #------------------
+    # attempt to autodetect the decvice
+    ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
+    if ddp:
+        # one GPU per rank with nccl if there are GPUs, otherwise CPU ranks with gloo
+        ddp_rank = int(os.environ['RANK'])
+        ddp_local_rank = int(os.environ['LOCAL_RANK'])
+        ddp_world_size = int(os.environ['WORLD_SIZE'])
+        if torch.cuda.is_available():
+            device = f'cuda:{ddp_local_rank}'
+            torch.cuda.set_device(device)
+        else:
+            device = "cpu"
+            cores = pin_cpu_threads(ddp_local_rank, int(os.environ.get('LOCAL_WORLD_SIZE', ddp_world_size)))
+            print(f"rank {ddp_rank}: {len(cores)} threads on cores {cores[0]}-{cores[-1]}")
+        init_process_group(backend='nccl' if device.startswith('cuda') else 'gloo')
+        master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
+    else:
+        # vanilla, non-DDP run
+        ddp_rank = 0
+        ddp_local_rank = 0
+        ddp_world_size = 1
+        master_process = True
+        # attempt to autodetect device
+        device = "cpu"
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+            device = "mps"
+        print(f"using device: {device}")
+
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+
+    ##### Code Reproducibility를 위해서 시드 고정
+    torch.manual_seed(1337) 
     if torch.cuda.is_available():
-        device = "cuda"
-    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-        device = "mps"
-    print(f"using device: {device}")
-
-device_type = "cuda" if device.startswith("cuda") else "cpu"
-
-##### Code Reproducibility를 위해서 시드 고정
-torch.manual_seed(1337) 
-if torch.cuda.is_available():
-    torch.cuda.manual_seed(1337)
-#####
-
-total_batch_size = 524288 # 2**19 ~0.5M, in number of tokens
-B = 32 #64 #32 #16 #4 # micro batch size
-T = 1024 #32 # sequence length
-assert total_batch_size % (B * T * ddp_world_size) == 0, "make sure total_batch_size is divisible by B * T * ddp_world_size"
-grad_accum_steps = total_batch_size // (B * T * ddp_world_size)
-if master_process:
-    print(f"total desired batch size: {total_batch_size}")
-    print(f"=> calculated gradient accumulation steps: {grad_accum_steps}")
-
-print("I am GPU ", ddp_rank)
-print("Bye")
-
-train_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train")
-val_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="val")
-
-### 최적화 #1. 
-torch.set_float32_matmul_precision('high') ### highest 에서 fp32를 사용하는 것 대신, TF32를 사용함으로써, Precision을 아주 살짝 포기하고, 전체 연산 속도를 높인다.
-
-
-# get logit
-# logits,loss = model(x, y)
-# print(logits.shape) #torch.Size([4, 32, 50257]) 아웃풋 로짓의 크기는 4x32에 대한 50257 토큰개수만큼-. 각 위치 다음에 무엇이 오는가에 대한 로짓값이 됨.
-# print(loss)
-
-# create model
-model = GPT(GPTConfig(vocab_size=50304)) # model = GPT(GPTConfig())
-model.to(device)
-# model = torch.compile(model) ### 이 한줄로 추가 최적화 #3. gcc처럼 컴파일하여 사용하는 셈.
-use_compile = False # torch.compile interferes with HellaSwag eval and Generation. TODO fix
-if use_compile:
-    model = torch.compile(model)
-
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model
-
-max_lr = 6e-4
-min_lr = max_lr * 0.1
-warmup_steps = 715 # 10
-max_steps = 19073 # 50
-def get_lr(it):
-    # 1) linear warmup for warmup_iters steps
-    if it < warmup_steps:
-        return max_lr * (it+1) / warmup_steps
-    # 2) if it > lr_decay_iters, return min learning rate
-    if it > max_steps:
-        return min_lr
-    # 3) in between, use cosine decay down to min learning rate
-    decay_ratio = (it - warmup_steps) / (max_steps - warmup_steps)
-    assert 0 <= decay_ratio <= 1
-    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))
-    return min_lr + coeff * (max_lr - min_lr)
-
-# optimize!
-# optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8) # Adam에 있는 버그를 수정한 AdamW를 사용한다. SGD보다 최적화 속도가 더 빠름
-optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type)
-
-# create the log directory we will write checkpoints to and log to
-log_dir = "log"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"log.txt")
-with open(log_file, "w") as f: # open for writing to clear the file
-    pass
-
-for step in range(max_steps):
-    t0 = time.time()
-    last_step = (step == max_steps - 1)
-
-    if step % 250 == 0 or last_step:
-        model.eval()
-        val_loader.reset()
-        with torch.no_grad():
-            val_loss_accum = 0.0
-            val_loss_steps = 20
-            for _ in range(val_loss_steps):
-                x, y = val_loader.next_batch()
-                x, y = x.to(device), y.to(device)
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(x, y)
-                loss = loss / val_loss_steps
-                val_loss_accum += loss.detach()
-        if ddp:
-            dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
+        torch.cuda.manual_seed(1337)
+    #####
+
+    total_batch_size = 524288 # 2**19 ~0.5M, in number of tokens
+    B = 32 #64 #32 #16 #4 # micro batch size
+    T = 1024 #32 # sequence length
+    assert total_batch_size % (B * T * ddp_world_size) == 0, "make sure total_batch_size is divisible by B * T * ddp_world_size"
+    grad_accum_steps = total_batch_size // (B * T * ddp_world_size)
+    if master_process:
+        print(f"total desired batch size: {total_batch_size}")
+        print(f"=> calculated gradient accumulation steps: {grad_accum_steps}")
+
+    print("I am GPU ", ddp_rank)
+    print("Bye")
+
+    # the log directory we will write checkpoints to and log to, and the checkpoint to resume from, if any
+    log_dir = "log"
+    checkpoint_every = 5000 # steps between checkpoints, a multiple of the validation interval (250)
+    keep_checkpoints = 3 # only the newest few checkpoints are kept on disk
+    resume = None
+    if args.resume:
+        resume_path = latest_checkpoint(log_dir)
+        if resume_path is None:
+            print(f"no checkpoint found in {log_dir}, starting from scratch")
+        else:
+            resume = read_checkpoint(resume_path, device="cpu")
+            if master_process:
+                print(f"resuming from {resume_path} at step {resume['step']}")
+            # with the same number of processes every rank takes up its own state; otherwise the data loaders
+            # re-map the position of the rank furthest behind onto the new ranks (see resume_state in data.py)
+            if len(resume['train_state']) == ddp_world_size:
+                resume_train_state = resume['train_state'][ddp_rank]
+            else:
+                resume_train_state = resume['train_state'][0]
+                if master_process:
+                    print(f"re-mapping the data position from {len(resume['train_state'])} to {ddp_world_size} processes")
+
+    shuffle_data = False # document-level shuffling across shards, needs the .idx files written by fineweb.py
+    shuffle_shards_per_group = 8 # shards whose documents are mixed together at a time, None for the whole split
+    if shuffle_data:
+        train_loader = ShuffledDataLoader(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train", shards_per_group=shuffle_shards_per_group)
+    else:
+        train_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train")
+    if resume is not None:
+        loader_state = resume_train_state['loader']
+        if len(resume['train_state']) != ddp_world_size:
+            loader_state = train_loader.resume_state([s['loader'] for s in resume['train_state']])
+        train_loader.load_state_dict(loader_state) # continue after the last consumed batch
+    prefetch_batches = 4 # batches kept ready by a background thread, 0 to load synchronously inside the step
+    if prefetch_batches > 0:
+        train_loader = PrefetchLoader(train_loader, depth=prefetch_batches, pin_memory=(device_type == "cuda"))
+    # the validation windows (the first val_loss_steps batches of the val split) are read once and kept on the device
+    val_loss_steps = 20
+    val_batch_size = 64 # rows per eval forward, larger than B since nothing is kept for a backward pass
+    val_set = ValidationSet(B, T, val_loss_steps, ddp_rank, ddp_world_size, device)
+    hella_batch_size = 16 # HellaSwag examples (x4 candidate rows) per eval forward
+
+    ### 최적화 #1. 
+    torch.set_float32_matmul_precision('high') ### highest 에서 fp32를 사용하는 것 대신, TF32를 사용함으로써, Precision을 아주 살짝 포기하고, 전체 연산 속도를 높인다.
+
+
+    # get logit
+    # logits,loss = model(x, y)
+    # print(logits.shape) #torch.Size([4, 32, 50257]) 아웃풋 로짓의 크기는 4x32에 대한 50257 토큰개수만큼-. 각 위치 다음에 무엇이 오는가에 대한 로짓값이 됨.
+    # print(loss)
+
+    # create model
+    # activation recomputation trades an extra forward of the chosen parts for activation memory, so a
+    # memory-limited host can raise B and cut grad_accum_steps; python bench.py --recompute reports the trade
+    recompute = "none" # none, block, attn (attention only) or mlp (MLP only)
+    recompute_every = 1 # only in every k-th block
+    model = GPT(GPTConfig(vocab_size=50304, recompute=recompute, recompute_every=recompute_every)) # model = GPT(GPTConfig())
+    if resume is not None:
+        model.load_state_dict(resume['model'])
+    model.to(device)
+    raw_model = model # the GPT itself, under the compile and DDP wrappers below, which share its parameters
+    # model = torch.compile(model) ### 이 한줄로 추가 최적화 #3. gcc처럼 컴파일하여 사용하는 셈.
+    use_compile = False
+    eval_model = model
+    hella_pad_to = None
+    if use_compile:
+        model = torch.compile(model)
+        # validation and HellaSwag get their own compile with dynamic shapes, so their batches don't keep
+        # recompiling the static training graph; HellaSwag batches are padded to a few lengths on top of that.
+        # generate stays eager, its KV cache grows by one position every token
+        eval_model = torch.compile(raw_model, dynamic=True)
+        hella_pad_to = 64
+
+    # ZeRO-style sharding over the DDP ranks (see zero.py): none, optimizer (the AdamW state), or gradients
+    # (the AdamW state and the gradients, reduced to their owning rank instead of all-reduced by DDP)
+    zero_shard = "none"
+    shard_gradients = ddp and zero_shard == "gradients"
+    if ddp and not shard_gradients:
+        model = DDP(model, device_ids=[ddp_local_rank] if device_type == "cuda" else None)
+
+    max_lr = 6e-4
+    min_lr = max_lr * 0.1
+    warmup_steps = 715 # 10
+    max_steps = 19073 # 50
+    def get_lr(it):
+        # 1) linear warmup for warmup_iters steps
+        if it < warmup_steps:
+            return max_lr * (it+1) / warmup_steps
+        # 2) if it > lr_decay_iters, return min learning rate
+        if it > max_steps:
+            return min_lr
+        # 3) in between, use cosine decay down to min learning rate
+        decay_ratio = (it - warmup_steps) / (max_steps - warmup_steps)
+        assert 0 <= decay_ratio <= 1
+        coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))
+        return min_lr + coeff * (max_lr - min_lr)
+
+    # optimize!
+    # optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8) # Adam에 있는 버그를 수정한 AdamW를 사용한다. SGD보다 최적화 속도가 더 빠름
+    optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type, shard=zero_shard if ddp else "none")
+    grad_shards = ShardedGradients(raw_model, optimizer) if shard_gradients else None
+    if resume is not None:
+        optimizer.load_state_dict(resume['optimizer'])
+
+    # create the log directory we will write checkpoints to and log to
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"log.txt")
+    if resume is None:
+        with open(log_file, "w") as f: # open for writing to clear the file
+            pass
+    checkpointer = AsyncCheckpointer(log_dir, keep_last=keep_checkpoints)
+    start_step = 0
+    if resume is not None:
+        start_step = resume['step']
+        set_rng_state(resume_train_state['rng'])
         if master_process:
-            print(f"validation loss: {val_loss_accum.item():.4f}")
-            with open(log_file, "a") as f:
-                f.write(f"{step} val {val_loss_accum.item():.4f}\n")
-            if step > 0 and (step % 5000 == 0 or last_step):
-                # optionally write model checkpoints
-                checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'config': raw_model.config,
-                    'step': step,
-                    'val_loss': val_loss_accum.item(),
-                    'optimizer': optimizer.state_dict()  # Save optimizer state
-                }
-                # you might also want to add optimizer.state_dict() and
-                # rng seeds etc., if you wanted to more exactly resume training
-                torch.save(checkpoint, checkpoint_path)
-        # validation 단계이기 때문에, no backward 
-
-    # once in a while evaluate hellaswag
-    if (step % 250 == 0 or last_step) and (not use_compile):
-        num_correct_norm = 0
-        num_total = 0
-        for i, example in enumerate(iterate_examples("val")):
-            # only process examples where i % ddp_world_size == ddp_rank
-            if i % ddp_world_size != ddp_rank:
-                continue
-            # render the example into tokens and labels
-            _, tokens, mask, label = render_example(example)
-            tokens = tokens.to(device)
-            mask = mask.to(device)
-            # get the logits
-            with torch.no_grad():
+            # the steps from start_step on run (and log) again, drop what the interrupted run logged for them
+            truncate_log(log_file, start_step)
+            truncate_log(os.path.join(log_dir, "metrics.jsonl"), start_step)
+        resume = None # the CPU copy of the state is not needed anymore
+
+    # instrumentation: per-phase step times (device syncs at phase boundaries only if enabled), peak memory,
+    # MFU, all streamed as one JSON object per line to log/metrics.jsonl; optionally profile a few steps
+    instrument_phases = False
+    peak_flops = 312e12 if device_type == "cuda" else None # per device, A100 bf16; None (no MFU) if unknown
+    profile_start_step = -1 # e.g. 10 to profile steps 10..10+profile_num_steps-1 into log/trace_*.json
+    profile_num_steps = 5
+    timer = StepTimer(device_type, enabled=instrument_phases)
+    metrics = MetricsLogger(os.path.join(log_dir, "metrics.jsonl"), enabled=master_process, append=(start_step > 0))
+    profiler = ProfilerHook(log_dir, profile_start_step, profile_num_steps, device_type)
+    num_params = sum(p.numel() for p in raw_model.parameters())
+    last_compile_stats = None
+
+    for step in range(start_step, max_steps):
+        t0 = time.time()
+        last_step = (step == max_steps - 1)
+        profiler.step_begin(step)
+
+        if step % 250 == 0 or last_step:
+            with timer.phase("val"):
+                val_loss, val_position_loss, val_doc_loss = evaluate_loss(eval_model, val_set, val_batch_size, device_type)
+            if master_process:
+                print(f"validation loss: {val_loss:.4f} | per-document: {val_doc_loss:.4f}")
+                with open(log_file, "a") as f:
+                    f.write(f"{step} val {val_loss:.4f}\n")
+                metrics.log(step=step, kind="val", val_loss=val_loss, val_doc_loss=val_doc_loss,
+                            val_position_loss=[round(l, 4) for l in val_position_loss])
+            if step > start_step and (step % checkpoint_every == 0 or last_step):
+                with timer.phase("checkpoint"):
+                    # every rank contributes where its data loader is and its RNG state, so a resumed run
+                    # neither replays nor skips batches; the state is taken before this step's update
+                    train_state = {'loader': train_loader.state_dict(), 'rng': rng_state()}
+                    train_states = [train_state]
+                    if ddp:
+                        train_states = [None] * ddp_world_size
+                        dist.all_gather_object(train_states, train_state)
+                    if ddp and zero_shard != "none":
+                        optimizer.consolidate_state_dict(to=0) # gather the AdamW shards to rank 0, every rank takes part
+                    if master_process:
+                        # copy to CPU here, the write to disk happens on a background thread
+                        checkpoint = snapshot({
+                            'model': raw_model.state_dict(),
+                            'config': raw_model.config,
+                            'step': step,
+                            'val_loss': val_loss,
+                            'optimizer': optimizer.state_dict(),  # Save optimizer state
+                            'train_state': train_states,
+                        })
+                        checkpointer.save(checkpoint, step)
+            # validation 단계이기 때문에, no backward 
+
+        # once in a while evaluate hellaswag
+        if step % 250 == 0 or last_step:
+            with timer.phase("hellaswag"):
+                # each process scores the examples where i % ddp_world_size == ddp_rank
+                num_correct_norm, num_total = evaluate_hellaswag(eval_model, device, device_type, hella_batch_size, ddp_rank, ddp_world_size, hella_pad_to)
+                # reduce the stats across all processes
+                if ddp:
+                    num_total = torch.tensor(num_total, dtype=torch.long, device=device)
+                    num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
+                    dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
+                    dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
+                    num_total = num_total.item()
+                    num_correct_norm = num_correct_norm.item()
+                acc_norm = num_correct_norm / num_total
+            if master_process:
+                print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
+                with open(log_file, "a") as f:
+                    f.write(f"{step} hella {acc_norm:.4f}\n")
+                metrics.log(step=step, kind="hella", acc_norm=acc_norm, num_correct_norm=num_correct_norm, num_total=num_total)
+
+        # once in a while generate from the model (except step 0, which is noise)
+        if (step > 0 and step % 250 == 0) or last_step:
+            with timer.phase("sample"):
+                model.eval()
+                num_return_sequences = 4
+                max_length = 32
+                tokens = enc.encode("Hello, I'm a language model,")
+                sample_rng = torch.Generator(device=device)
+                sample_rng.manual_seed(42 + ddp_rank)
                 with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(tokens)
-                pred_norm = get_most_likely_row(tokens, mask, logits)
-            num_total += 1
-            num_correct_norm += int(pred_norm == label)
-        # reduce the stats across all processes
+                    completions = raw_model.generate_batch([tokens] * num_return_sequences, max_length - len(tokens), top_k=50,
+                                                           eot=enc.eot_token, generator=sample_rng)
+            # print the generated text
+            for i, completion in enumerate(completions):
+                decoded = enc.decode(tokens + completion)
+                print(f"rank {ddp_rank} sample {i}: {decoded}")
+
+
+        # training loop
+        t_train = time.time() # MFU counts only the training part of the step, not the periodic eval blocks
+        model.train()
+        optimizer.zero_grad() ## 항상 제로그레디언트로 시작해야 함 
+        loss_accum = 0.0
+        data_time = 0.0 # time spent waiting on the data loader during this step
+        for micro_step in range(grad_accum_steps):
+            td = time.time()
+            with timer.phase("data"):
+                x, y = train_loader.next_batch()
+            data_time += time.time() - td
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            if isinstance(model, DDP):
+                # only all-reduce the gradients in the backward of the last micro step. DDP reads this flag in
+                # forward (that is when it prepares the reducer), so it has to be set before the forward pass
+                model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1)
+            with timer.phase("forward"):
+                with torch.autocast(device_type=device_type, dtype=torch.bfloat16): ## uncommented
+                    logits, loss = model(x, y, return_logits=False) ## uncommented, only the loss: logits is None
+                loss = loss / grad_accum_steps
+                loss_accum += loss.detach()
+            # DDP overlaps the gradient all-reduce with the backward of the last micro step, so that one is
+            # timed on its own: backward_sync minus the mean backward approximates the all-reduce cost
+            with timer.phase("backward_sync" if ddp and micro_step == grad_accum_steps - 1 else "backward"):
+                loss.backward()
         if ddp:
-            num_total = torch.tensor(num_total, dtype=torch.long, device=device)
-            num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
-            dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
-            dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
-            num_total = num_total.item()
-            num_correct_norm = num_correct_norm.item()
-        acc_norm = num_correct_norm / num_total
+            with timer.phase("loss_allreduce"):
+                dist.all_reduce(loss_accum, op=dist.ReduceOp.SUM) # gloo has no AVG
+                loss_accum /= ddp_world_size
+
+        # with torch.autocast(device_type=device, dtype=torch.bfloat16):
+        #     logits, loss = model(x, y)
+        #     # import code; code.interact(local=locals()) ### >>> logits.dtype ==> torch.bfloat16
+        # import code; code.interact(local=locals()) ### >>> logits.dtype ==> torch.float32 자료형이 fp32임. 이를 TF32로 고쳐서 아주 약간만 precision을 희생시킨다면, 8배의 TFLOPS를 얻어낼 수 있다. 이건 공짜이기 때문에, Andrej가 가장 좋아하는 최적화 방법론 중 하나
+
+        # logits, loss = model(x, y)
+        # loss.backward()
+
+        with timer.phase("clip"):
+            if grad_shards is not None:
+                grad_shards.finish() # this rank's gradient shard, averaged over ranks and micro steps
+                norm = grad_shards.clip_grad_norm_(1.0) # the norm is over all the shards
+            else:
+                norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) ## model이 아주 가끔씩 shock을 당하는 일을 막기 위함.
+        lr = get_lr(step)
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr    
+        with timer.phase("optimizer"):
+            optimizer.step() # 파라미터 업데이트
+        ##uncommented
+        if device_type == "cuda":
+            torch.cuda.synchronize() ### CUDA가 있을 때에 GPU와 CPU가 별도로 실행되는 것을 막기 위해, CPU가 GPU의 실행을 기다리는 역할.
+        ##
+        t1 = time.time()
+        dt = (t1 - t0) * 1000 # time difference in milliseconds
+        tokens_processed = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
+        tokens_per_sec = tokens_processed / (t1 - t0)
+        mfu = estimate_mfu(raw_model.config, num_params, T, tokens_processed / (t1 - t_train), peak_flops and peak_flops * ddp_world_size)
+        profiler.step_end(step)
+        phases = timer.reset()
+        peak_mem = peak_memory(device_type)
         if master_process:
-            print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
-            with open(log_file, "a") as f:
-                f.write(f"{step} hella {acc_norm:.4f}\n")
-
-    # once in a while generate from the model (except step 0, which is noise)
-    if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
-        model.eval()
-        num_return_sequences = 4
-        max_length = 32
-        tokens = enc.encode("Hello, I'm a language model,")
-        tokens = torch.tensor(tokens, dtype=torch.long)
-        tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
-        xgen = tokens.to(device)
-        sample_rng = torch.Generator(device=device)
-        sample_rng.manual_seed(42 + ddp_rank)
-        while xgen.size(1) < max_length:
-            # forward the model to get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(xgen) # (B, T, vocab_size)
-                # take the logits at the last position
-                logits = logits[:, -1, :] # (B, vocab_size)
-                # get the probabilities
-                probs = F.softmax(logits, dim=-1)
-                # do top-k sampling of 50 (huggingface pipeline default)
-                # topk_probs here becomes (5, 50), topk_indices is (5, 50)
-                topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                # select a token from the top-k probabilities
-                # note: multinomial does not demand the input to sum to 1
-                ix = torch.multinomial(topk_probs, 1, generator=sample_rng) # (B, 1)
-                # gather the corresponding indices
-                xcol = torch.gather(topk_indices, -1, ix) # (B, 1)
-                # append to the sequence
-                xgen = torch.cat((xgen, xcol), dim=1)
-        # print the generated text
-        for i in range(num_return_sequences):
-            tokens = xgen[i, :max_length].tolist()
-            decoded = enc.decode(tokens)
-            print(f"rank {ddp_rank} sample {i}: {decoded}")
-
-
-    # training loop
-    model.train()
-    optimizer.zero_grad() ## 항상 제로그레디언트로 시작해야 함 
-    loss_accum = 0.0
-    for micro_step in range(grad_accum_steps):
-        x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
-        with torch.autocast(device_type=device_type, dtype=torch.bfloat16): ## uncommented
-            logits, loss = model(x, y) ## uncommented
-        loss = loss / grad_accum_steps
-        loss_accum += loss.detach()
-        if ddp:
-            model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1)
-        loss.backward()
+            mfu_str = f" | mfu: {100 * mfu:.2f}%" if mfu is not None else ""
+            print(f"step {step:4d} | loss: {loss_accum.item():.6f} | lr {lr:.4e} | norm: {norm:.4f} | dt: {dt:.2f}ms | data: {data_time*1000:.2f}ms | tok/sec: {tokens_per_sec:.0f}{mfu_str} | tokens_processed: {tokens_processed}")
+            metrics.log(step=step, kind="train", loss=loss_accum.item(), lr=lr, norm=norm.item(), dt_ms=dt,
+                        data_ms=data_time * 1000, tokens_per_sec=tokens_per_sec, mfu=mfu, peak_mem_bytes=peak_mem,
+                        phases_ms=phases)
+            if use_compile:
+                # report every step that compiled something: the first steps, the first eval, any recompile
+                stats = compile_stats()
+                if stats != last_compile_stats:
+                    print(f"torch.compile: {format_compile_stats(stats)} so far")
+                    metrics.log(step=step, kind="compile", **stats)
+                    last_compile_stats = stats
+
+    checkpointer.wait() # the last checkpoint may still be writing
     if ddp:
-        dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
-
-    # with torch.autocast(device_type=device, dtype=torch.bfloat16):
-    #     logits, loss = model(x, y)
-    #     # import code; code.interact(local=locals()) ### >>> logits.dtype ==> torch.bfloat16
-    # import code; code.interact(local=locals()) ### >>> logits.dtype ==> torch.float32 자료형이 fp32임. 이를 TF32로 고쳐서 아주 약간만 precision을 희생시킨다면, 8배의 TFLOPS를 얻어낼 수 있다. 이건 공짜이기 때문에, Andrej가 가장 좋아하는 최적화 방법론 중 하나
-    
-    # logits, loss = model(x, y)
-    # loss.backward()
-
-    norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) ## model이 아주 가끔씩 shock을 당하는 일을 막기 위함.
-    lr = get_lr(step)
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr    
-    optimizer.step() # 파라미터 업데이트
-    ##uncommented
-    if device_type == "cuda":
-        torch.cuda.synchronize() ### CUDA가 있을 때에 GPU와 CPU가 별도로 실행되는 것을 막기 위해, CPU가 GPU의 실행을 기다리는 역할.
-    ##
-    t1 = time.time()
-    dt = (t1 - t0) * 1000 # time difference in milliseconds
-    tokens_processed = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
-    tokens_per_sec = tokens_processed / (t1 - t0)
-    if master_process:
-        print(f"step {step:4d} | loss: {loss_accum.item():.6f} | lr {lr:.4e} | norm: {norm:.4f} | dt: {dt:.2f}ms | tok/sec: {tokens_per_sec:.0f} | tokens_processed: {tokens_processed}")
+        # collect the garbage of the collectives (ZeroRedundancyOptimizer leaves some) while the process group
+        # is still up: an automatic gc pass landing inside destroy_process_group can hang the exit on gloo
+        gc.collect()
+        destroy_process_group()
 
-if ddp:
-    destroy_process_group()
-    
-import sys; sys.exit(0) # 이 아래줄은 모두 실행하지 않음.
 
-num_return_sequences = 5
-max_length = 30
-
-# model = GPT.from_pretrained('gpt2')
-model = GPT(GPTConfig())
-model.eval()
-model.to(device)
-
-# prefix tokens
-import tiktoken
-enc = tiktoken.get_encoding('gpt2')
-tokens = enc.encode("Hello, I'm a language model,")
-tokens = torch.tensor(tokens, dtype=torch.long) # (8,)
-tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1) # (5, 8)
-x = tokens.to(device)
-
-# generate! right now x is (B, T) where B=5, T=8
-torch.manual_seed(42)
-# torch.cuda.manual_seed(42)
-while x.size(1) < max_length:
-    with torch.no_grad(): ## Backward로 가지 않는다고 torch에게 알려주는 것. 그러면 캐싱 등 고생하지 않게 됨.
-        logits = model(x)
-        # take the logits at the last position  #약간의 낭비는 있는 셈
-        logits = logits[:, -1, :]
-        # get the probabilities
-        probs = F.softmax(logits, dim=-1)
-        # do top-k sampling of 50 (huggingface pipeline default)
-        #topk_probs here becomes (5, 50), topk_indices is (5, 50)
-        topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-        # select a token from the top-k probabilities
-        ix = torch.multinomial(topk_probs, 1)
-        # gather the corresponding indices
-        xcol = torch.gather(topk_indices, -1, ix)
-        # append to the sequence
-        x = torch.cat((x, xcol), dim=1)
-
-for i in range(num_return_sequences):
-    # print(x[i])
-    tokens = x[i, :max_length].tolist()
-    decoded = enc.decode(tokens)
-    print(">", decoded)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+ZeRO-style sharding (https://arxiv.org/abs/1910.02054) of the training state over the DDP ranks.
+- shard="optimizer": ZeroRedundancyOptimizer around the AdamW of configure_optimizers. Each rank keeps
+  the moment buffers of ~1/world_size of the parameters, steps only those and broadcasts the updated
+  weights; gradients are still all-reduced by DDP.
+- shard="gradients": additionally, the model is not wrapped in DDP. As soon as a parameter's gradient
+  is ready during backward it is reduced to the rank owning that parameter and freed everywhere else,
+  so each rank holds the gradients of its own shard only (ShardedGradients).
+The decay/no-decay parameter groups are kept, and setting the lr of optimizer.param_groups works as
+for a plain AdamW. For checkpoints, consolidate_state_dict(to=0) on every rank, then state_dict() on
+rank 0 returns the layout of a plain AdamW, which load_state_dict() accepts back on every rank.
+"""
+
+import torch
+import torch.distributed as dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+SHARD_MODES = ("none", "optimizer", "gradients")
+
+# -----------------------------------------------------------------------------
+
+def sharded_adamw(optim_groups, **adamw_kwargs):
+    # the AdamW of configure_optimizers, with its state partitioned over the ranks of the default process group
+    return ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW, **adamw_kwargs)
+
+class ShardedGradients:
+    """
+    Keeps only this rank's share of the gradients: a hook on every parameter reduces its gradient to the
+    owning rank (as partitioned by the ZeroRedundancyOptimizer) after each backward, every micro step,
+    and drops it on the other ranks. finish() hands the averaged gradients to the optimizer.
+    """
+
+    def __init__(self, model, optimizer):
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        # the parameters this rank steps are those of its local optimizer, tell everyone which they are
+        params = [p for p in model.parameters() if p.requires_grad]
+        owned = {p for group in optimizer.optim.param_groups for p in group['params']}
+        owned_by_rank = [None] * self.world_size
+        dist.all_gather_object(owned_by_rank, [i for i, p in enumerate(params) if p in owned])
+        self.owner = {params[i]: rank for rank, indices in enumerate(owned_by_rank) for i in indices}
+        self.grads = {} # owned parameter -> its gradient summed over ranks and micro steps
+        with torch.no_grad():
+            for p in model.parameters():
+                # without DDP nobody else makes sure all ranks start from the same weights
+                dist.broadcast(p.data, src=0)
+                if p.requires_grad:
+                    p.register_post_accumulate_grad_hook(self._reduce_grad)
+
+    def _reduce_grad(self, p):
+        owner = self.owner[p]
+        dist.reduce(p.grad, dst=owner, op=dist.ReduceOp.SUM)
+        if owner == self.rank:
+            if p in self.grads:
+                self.grads[p].add_(p.grad)
+            else:
+                self.grads[p] = p.grad
+        p.grad = None
+
+    def finish(self):
+        # the owned gradients back in .grad, averaged over ranks like DDP does; call after the last backward of a step
+        for p, grad in self.grads.items():
+            p.grad = grad.div_(self.world_size)
+        self.grads = {}
+
+    def clip_grad_norm_(self, max_norm):
+        # clip_grad_norm_ over the gradients of all shards: the total norm needs the squares of every rank's shard
+        grads = [p.grad for p in self.owner if p.grad is not None and self.owner[p] == self.rank]
+        device = next(iter(self.owner)).device
+        norm_sq = torch.zeros((), dtype=torch.float32, device=device)
+        for g in grads:
+            norm_sq += g.detach().float().pow(2).sum()
+        dist.all_reduce(norm_sq, op=dist.ReduceOp.SUM)
+        total_norm = norm_sq.sqrt()
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for g in grads:
+            g.detach().mul_(clip_coef.to(g.dtype))
+        return total_norm